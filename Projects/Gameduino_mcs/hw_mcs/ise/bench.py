@@ -0,0 +1,249 @@
+"""
+bench - timing for the hot paths of prep and genrams
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+
+Runs each benchmark on synthetic, seeded inputs and reports, per function:
+
+* time per call (best of the repeats) and throughput in MB of input per second
+* peak memory: how far the resident set rose above its size when the timed calls started, in KB.
+  On Linux the high-water mark is reset after setup, through ``/proc/self/clear_refs``, so memory
+  that setup used and freed does not hide the benchmark's own peak; elsewhere this falls back to the
+  growth of the maximum resident set, which reads 0 when setup's peak was higher
+
+Allocation counts are not reported: Python 2 has no ``tracemalloc``, and numpy buffers and
+strings, where most of the memory goes, are not tracked by the garbage collector.
+
+Every benchmark runs in its own forked process, so peak memory is not hidden by an
+earlier benchmark's high-water mark.  The inputs are:
+
+* flat - flat-color character tiles, as in title screens and maps
+* photo - a photographic screen, smooth color fields with noise
+* sheet - a large sprite sheet of 32x32 frames on a transparent background
+* mem - a full 32K Gameduino memory image, with blank runs, repeated tables and noise
+
+Usage::
+
+    python bench.py                     # run everything, print a table
+    python bench.py -k encode -k dump   # only benchmarks whose names contain these
+    python bench.py -o today.json       # also save the results
+    python bench.py -c last.json        # compare with earlier results
+"""
+
+import sys
+import os
+import gc
+import time
+import json
+import getopt
+import resource
+import platform
+import subprocess
+import multiprocessing
+import StringIO
+from array import array
+
+import numpy
+import Image
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+import prep
+import genrams
+
+def flat(w, h, seed):
+    rs = numpy.random.RandomState(seed)
+    colors = rs.randint(0, 256, (6, 4)).astype(numpy.uint8)
+    colors[:, 3] = rs.choice([0, 255], 6)
+    tiles = colors[rs.randint(0, 4, (40, 8, 8))]
+    tiles[::3] = colors[rs.randint(0, 6, (len(tiles[::3]), 8, 8))]
+    (y, x) = numpy.mgrid[0:h / 8, 0:w / 8]
+    px = tiles[(y * 7 + x * 3) % len(tiles)].transpose(0, 2, 1, 3, 4).reshape(h, w, 4)
+    return Image.fromstring("RGBA", (w, h), px.tostring())
+
+def photo(w, h, seed):
+    rs = numpy.random.RandomState(seed)
+    (y, x) = numpy.mgrid[0:h, 0:w].astype(float)
+    f = rs.uniform(.005, .05, (3, 2))
+    px = numpy.dstack([128 + 100 * numpy.sin(f[c, 0] * x + f[c, 1] * y + c) for c in range(3)])
+    px += rs.normal(0, 12, px.shape)
+    return Image.fromstring("RGB", (w, h), px.clip(0, 255).astype(numpy.uint8).tostring())
+
+def sheet(w, h, seed):
+    rs = numpy.random.RandomState(seed)
+    colors = rs.randint(0, 256, (15, 3))
+    px = numpy.zeros((h, w, 4), numpy.uint8)
+    (y, x) = numpy.mgrid[0:32, 0:32]
+    for fy in range(0, h, 32):
+        for fx in range(0, w, 32):
+            for blob in range(4):
+                (cx, cy, r) = (rs.randint(4, 28), rs.randint(4, 28), rs.randint(3, 10))
+                inside = (x - cx) ** 2 + (y - cy) ** 2 < r * r
+                px[fy:fy + 32, fx:fx + 32][inside] = list(colors[rs.randint(15)]) + [255]
+    return Image.fromstring("RGBA", (w, h), px.tostring())
+
+def mem(seed):
+    rs = numpy.random.RandomState(seed)
+    m = numpy.zeros(32768, numpy.uint8)
+    m[0x0000:0x1000] = rs.randint(0, 40, 4096)                  # picture
+    m[0x1000:0x1a00] = numpy.tile(rs.randint(0, 256, 256), 10)  # characters
+    m[0x2000:0x2800] = rs.randint(0, 256, 2048)                 # palettes
+    m[0x4000:0x6000] = rs.randint(0, 256, 8192)                 # sprite images
+    return array('B', m.tostring())
+
+def benchmarks():
+    # (name, setup); setup returns the function to time and the size of its input in bytes
+    def encode_flat():
+        im = flat(512, 512, 1)
+        return (lambda: prep.encode(im), 4 * 512 * 512)
+    def encode_photo():
+        # encode() takes at most 256 distinct cells, and every photo cell is distinct
+        im = photo(128, 128, 2)
+        return (lambda: prep.encode(im), 3 * 128 * 128)
+    def encode_lossy_photo():
+        im = photo(400, 296, 2)
+        return (lambda: prep.encode_lossy(im), 3 * 400 * 296)
+    def getch_photo():
+        im = photo(400, 296, 2).convert("RGBA")
+        return (lambda: [prep.getch(im, x, y) for y in range(0, 296, 8) for x in range(0, 400, 8)], 4 * 400 * 296)
+    def palettize_photo():
+        im = photo(400, 296, 2)
+        return (lambda: prep.palettize(im, 256), 3 * 400 * 296)
+    def palettize_sheet():
+        ims = [sheet(256, 64, s) for s in range(16)]
+        return (lambda: prep.palettize(ims, 16), 16 * 4 * 256 * 64)
+    def palettize_sheet_streaming():
+        ims = [sheet(256, 64, s) for s in range(16)]
+        return (lambda: prep.palettize(ims, 16, streaming = True), 16 * 4 * 256 * 64)
+    def imageram_add():
+        rs = numpy.random.RandomState(3)
+        pages = [(size, rs.randint(0, size, 256)) for size in [4, 16, 256, 4, 16, 4] * 10]
+        def run():
+            ir = prep.ImageRAM(StringIO.StringIO())
+            for (size, page) in pages:
+                ir.add(page, size)
+        return (run, 256 * len(pages))
+    def imageram_addsprites():
+        im = prep.palettize(sheet(256, 192, 4), 4)
+        def run():
+            ir = prep.ImageRAM(StringIO.StringIO())
+            ir.addsprites("sheet", (32, 32), im, prep.PALETTE4A, (16, 16))
+        return (run, 256 * 192)
+    def dump_mem():
+        m = mem(5)
+        return (lambda: prep.dump(StringIO.StringIO(), "mem", m), len(m))
+    r = [(n, f) for (n, f) in locals().items() if callable(f)]
+
+    def geninit(name, args):
+        def setup():
+            fn = getattr(genrams, name)
+            m = mem(6)
+            img = {"geninit1": m[0x4000:0x8000], "geninit4": m[0:0x1000], "geninit4i": m[0x1000:0x2000],
+                   "geninit8": m[0x2000:0x2800], "geninit128x1": m[0:128]}[name]
+            return (lambda: [fn(img, *a) for a in args], len(img) * len(args))
+        return setup
+    r += [("genrams_geninit1", geninit("geninit1", [(i,) for i in range(8)])),
+          ("genrams_geninit4", geninit("geninit4", [(i,) for i in range(2)])),
+          ("genrams_geninit4i", geninit("geninit4i", [(i,) for i in range(2)])),
+          ("genrams_geninit8", geninit("geninit8", [()])),
+          ("genrams_geninit128x1", geninit("geninit128x1", [(i,) for i in range(8)]))]
+    return sorted(r)
+
+def status(field):
+    # A field of /proc/self/status, in KB
+    for l in open("/proc/self/status"):
+        if l.startswith(field + ":"):
+            return int(l.split()[1])
+
+def resetpeak():
+    # Reset the resident set high-water mark and return the resident set size in KB,
+    # or None where there is no /proc to do it
+    try:
+        f = open("/proc/self/clear_refs", "w")
+        f.write("5")
+        f.close()
+        return status("VmRSS")
+    except IOError:
+        return None
+
+def peak():
+    # The resident set high-water mark in KB
+    if os.path.exists("/proc/self/status"):
+        return status("VmHWM")
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def measure(setup, mintime, conn):
+    # Runs in a child process: time the benchmark and send back its numbers
+    (fn, nbytes) = setup()
+    fn()                                    # warm up: imports, caches
+    gc.collect()
+    rss0 = resetpeak()
+    if rss0 is None:
+        rss0 = peak()
+    times = []
+    start = time.time()
+    while len(times) < 3 or time.time() - start < mintime:
+        t0 = time.time()
+        fn()
+        times.append(time.time() - t0)
+    best = min(times)
+    conn.send({
+        "seconds": best,
+        "mb_per_s": nbytes / best / 1e6 if best else None,
+        "calls": len(times),
+        "peak_kb": peak() - rss0,
+        "input_bytes": nbytes})
+    conn.close()
+
+def run(setup, mintime):
+    (here_end, there) = multiprocessing.Pipe(False)
+    p = multiprocessing.Process(target = measure, args = (setup, mintime, there))
+    p.start()
+    there.close()
+    try:
+        result = here_end.recv()
+    except EOFError:
+        result = None       # the benchmark failed; its traceback is on stderr
+    p.join()
+    return result
+
+def revision():
+    try:
+        return subprocess.Popen(["git", "rev-parse", "--short", "HEAD"], cwd = here,
+                                stdout = subprocess.PIPE, stderr = subprocess.PIPE).communicate()[0].strip()
+    except OSError:
+        return ""
+
+def main(argv):
+    (opts, args) = getopt.getopt(argv, "k:o:c:t:")
+    keys = [v for (o, v) in opts if o == "-k"]
+    opts = dict(opts)
+    mintime = float(opts.get("-t", "0.5"))
+    before = json.load(open(opts["-c"]))["results"] if "-c" in opts else {}
+
+    results = {}
+    print "%-32s %10s %10s %9s" % ("benchmark", "ms/call", "MB/s", "peak KB"),
+    print " vs before" if before else ""
+    for (name, setup) in benchmarks():
+        if keys and not any([k in name for k in keys]):
+            continue
+        r = run(setup, mintime)
+        if r is None:
+            print "%-32s failed" % name
+            continue
+        results[name] = r
+        print "%-32s %10.2f %10.2f %9d" % (name, 1000 * r["seconds"], r["mb_per_s"] or 0, r["peak_kb"]),
+        if name in before:
+            print " %.2fx" % (before[name]["seconds"] / r["seconds"]),
+        print
+        sys.stdout.flush()
+
+    if "-o" in opts:
+        json.dump({"when": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "revision": revision(),
+                   "python": platform.python_version(),
+                   "numpy": numpy.__version__,
+                   "prep": prep.__version__,
+                   "results": results}, open(opts["-o"], "w"), indent = 2, sort_keys = True)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,8 +1,44 @@
+"""
+genrams - Gameduino RAM initialization for the FPGA build
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+
+Turns a 32K Gameduino memory image and the J1 firmware into ``generated.v``,
+the Verilog RAM modules with their INIT parameters.  As a script::
+
+    python genrams.py                   # sketches/proto/cold.dump -> ../verilog/generated.v
+    python genrams.py -m mem.dump -j cold.binbe -o generated.v
+
+Only the RAM modules whose part of the memory image changed are regenerated,
+using a manifest of content hashes kept next to the output.  If nothing changed,
+the output file is left untouched, so ISE does not resynthesize.
+
+The new contents can also go straight into an existing bitstream, without running ISE::
+
+    python genrams.py -m mem.dump -b top.bit -p new.bit
+    python genrams.py -b top.bit -p new.bit --bmm ipcore_dir/microblaze_mcs_v1_3_bd.bmm --firmware app.elf
+
+Only the block RAM frames and the CRCs of the bitstream change.  The RAMs are found in
+``top.bit`` by their contents in the old ``generated.v`` (or, if there is none yet, the new one),
+or by their PLACED sites in a BMM file; ``--firmware`` fills the other RAMs of the BMM file
+from an ELF or binary image.
+
+``--images dir`` also writes each RAM's contents as ``$readmemh`` (mem), ``.coe``, Intel HEX
+(hex) or raw binary (bin) files, chosen with ``--formats``, for example ``--formats mem,coe``.
+Like ``generated.v``, each file is only rewritten when its RAM's contents change.
+"""
+
 import string
 import array
 import sys
+import os
+import re
+import struct
 import time
+import json
+import getopt
+import hashlib
 import subprocess
+import numpy
 
 T4K_8_8 = string.Template("""
 module $ramname (
@@ -268,25 +304,18 @@ ram88 = string.Template("""
         .DPO(_bo[$i]));
 """)
 
-vv = open("../verilog/generated.v", "w")
+# Each INIT string is built by slicing rows out of one string that holds the
+# digits for the whole memory image, so the per-byte work is done by numpy
+HEXDIGITS = numpy.frombuffer("0123456789ABCDEF", numpy.uint8)
 
-pattern = range(100) * 200
+def image(img):
+    return numpy.frombuffer(bytearray(buffer(img)), numpy.uint8)
 
 def geninit1(img, i):
+    digits = (((image(img) >> i) & 1) + ord('0')).astype(numpy.uint8).tostring()
     r = []
     for j in range(64):
-        bytes = img[256 * j:256 * (j + 1)][::-1]
-        bits = [(1 & (b >> i)) for b in bytes]
-        r.append(".INIT_%02X(256'b%s)" % (j, "".join([str(b) for b in bits])))
-    return ",\n".join(r)
-
-def geninit4(img, i):
-    """ For 4-bit RAMs, each 256 bits holds half the init for 128 bytes """
-    r = []
-    for j in range(64):
-        bytes = img[64 * j:64 * (j + 1)]
-        bits = [(15 & (b >> (4 * i))) for b in bytes][::-1]
-        r.append(".INIT_%02X(256'h%s)" % (j, "".join(["%X"%b for b in bits])))
+        r.append(".INIT_%02X(256'b%s)" % (j, digits[256 * j:256 * (j + 1)][::-1]))
     return ",\n".join(r)
 
 def deinterleave(b, i):
@@ -297,89 +326,841 @@ def deinterleave(b, i):
     r |= (1 & (b >> (6+i))) << 3
     return r
 
-def geninit4i(img, i):
-    """ For 4-bit RAMs, each 256 bits holds half the init for 128 bytes """
+# deinterleave() of every byte value, for i = 0 and 1
+DEINTERLEAVE = [numpy.array([deinterleave(b, i) for b in range(256)], numpy.uint8) for i in range(2)]
+
+def nibbleinit(nibbles):
+    digits = HEXDIGITS[nibbles].tostring()
     r = []
     for j in range(64):
-        bytes = img[64 * j:64 * (j + 1)]
-        bits = [deinterleave(b, i) for b in bytes][::-1]
-        r.append(".INIT_%02X(256'h%s)" % (j, "".join(["%X"%b for b in bits])))
+        r.append(".INIT_%02X(256'h%s)" % (j, digits[64 * j:64 * (j + 1)][::-1]))
     return ",\n".join(r)
 
+def geninit4i(img, i):
+    """ For 4-bit RAMs, each 256 bits holds half the init for 128 bytes """
+    return nibbleinit(DEINTERLEAVE[i][image(img)])
+
 def geninit4(img, i):
     """ For 4-bit RAMs, each 256 bits holds half the init for 128 bytes """
-    r = []
-    for j in range(64):
-        bytes = img[64 * j:64 * (j + 1)]
-        bits = [(15 & (b >> (4 * i))) for b in bytes][::-1]
-        r.append(".INIT_%02X(256'h%s)" % (j, "".join(["%X"%b for b in bits])))
-    return ",\n".join(r)
+    return nibbleinit((image(img) >> (4 * i)) & 15)
 
 def geninit8(img):
+    a = image(img)
+    pairs = numpy.column_stack([HEXDIGITS[a >> 4], HEXDIGITS[a & 15]])
     r = []
     for j in range(64):
-        bytes = img[32 * j:32 * (j + 1)][::-1]
-        r.append(".INIT_%02X(256'h%s)" % (j, "".join(["%02X"%b for b in bytes])))
+        r.append(".INIT_%02X(256'h%s)" % (j, pairs[32 * j:32 * (j + 1)][::-1].tostring()))
     return ",".join(r)
 
 def geninit128x1(img, i):
-    bits = [(1 & (b >> i)) for b in img][::-1]
-    return ".INIT(128'b%s)" % "".join([str(b) for b in bits])
-
-from prep import encode
-import Image
+    digits = (((image(img) >> i) & 1) + ord('0')).astype(numpy.uint8).tostring()
+    return ".INIT(128'b%s)" % digits[::-1]
 
 def pad(a, sz):
     return array.array('B', (a.tostring() + (chr(0) * sz))[:sz])
 
-if 0:
-    meml = []
-    for l in open("sketches/logo.dump"):
-        meml += [int(f,16) for f in l.split()[1:17]]
-    assert len(meml) == 32768
-    mem = array.array('B', meml)
-else:
-    mem = array.array('B', [0] * 32768)
-    mem = array.array('B', open("sketches/proto/cold.dump").read())
-
-picimg = mem[0x0000:0x1000]
-chrimg = mem[0x1000:0x2000]
-palimg = mem[0x2000:0x2800]
-
-sprvalimg = mem[0x3000:0x3800]
-sprpalimg = mem[0x3800:0x4000]
-sprimg = mem[0x4000:0x8000]
-
-svn = subprocess.Popen("svnversion", stdout=subprocess.PIPE).stdout.read().strip()
-signature = ("Built %s from svn %s" % (time.ctime(), svn)).ljust(64)
-print len(signature), signature
-for (i, c) in enumerate(signature):
-    sprvalimg[0x700 + i] = ord(c)
-
-print >>vv, T16K_8_8.substitute(ramname = "RAM_SPRIMG",
-                                rams = "".join([bram11.substitute(i = i,
-                                                                  init = geninit1(sprimg, i)) for i in range(8)]))
-print >>vv, T4K_8_8.substitute(ramname = "RAM_PICTURE",
-                                rams = "".join([bram44.substitute(i = i,
-                                                                  init = geninit4(picimg, i)) for i in range(2)]))
-print >>vv, T4K_2_8.substitute(ramname = "RAM_CHR",
-                                rams = "".join([bram14.substitute(i = i,
-                                                                  init = geninit4i(chrimg, i)) for i in range(2)]))
-print >>vv, T2K_8_16.substitute(ramname = "RAM_PAL",
-                                rams = bram816.substitute(init = geninit8(palimg)))
-
-print >>vv, T2K_8_32.substitute(ramname = "RAM_SPRVAL",
-                                rams = bram832.substitute(init = geninit8(sprvalimg)))
-
-print >>vv, T2K_8_16.substitute(ramname = "RAM_SPRPAL",
-                                rams = bram816.substitute(init = geninit8(sprpalimg)))
-
-j1code = pad(array.array('B', open("sketches/j1firmware/cold.binbe").read()), 256) # bigendian
-j1codeimgl = array.array('B', j1code[1::2])
-print >>vv, T128_8_8.substitute(ramname = "RAM_CODEL",
-                                rams = "".join([ram88.substitute(i = i, init = geninit128x1(j1codeimgl, i)) for i in range(8)]))
-j1codeimgh = array.array('B', j1code[0::2])
-print >>vv, T128_8_8.substitute(ramname = "RAM_CODEH",
-                                rams = "".join([ram88.substitute(i = i, init = geninit128x1(j1codeimgh, i)) for i in range(8)]))
-
-sys.exit(0)
+def layout(mem, code):
+    """
+    The RAM modules of ``generated.v``, in order, for memory image ``mem`` and J1 firmware ``code``.
+    Each is (ramname, module template, RAM template, memory contents, INIT generator, RAM indices),
+    where RAM indices is None for a module built from a single RAM.
+    """
+    j1code = pad(code, 256) # bigendian
+    return [
+        ("RAM_SPRIMG",  T16K_8_8, bram11, mem[0x4000:0x8000], geninit1, range(8)),
+        ("RAM_PICTURE", T4K_8_8, bram44, mem[0x0000:0x1000], geninit4, range(2)),
+        ("RAM_CHR",     T4K_2_8, bram14, mem[0x1000:0x2000], geninit4i, range(2)),
+        ("RAM_PAL",     T2K_8_16, bram816, mem[0x2000:0x2800], geninit8, None),
+        ("RAM_SPRVAL",  T2K_8_32, bram832, mem[0x3000:0x3800], geninit8, None),
+        ("RAM_SPRPAL",  T2K_8_16, bram816, mem[0x3800:0x4000], geninit8, None),
+        ("RAM_CODEL",   T128_8_8, ram88, array.array('B', j1code[1::2]), geninit128x1, range(8)),
+        ("RAM_CODEH",   T128_8_8, ram88, array.array('B', j1code[0::2]), geninit128x1, range(8))]
+
+def moduleimage(module, signature):
+    """ The memory contents of one entry of :func:`layout`.  RAM_SPRVAL gets the build signature. """
+    (ramname, outer, inner, img, gen, indices) = module
+    if ramname == "RAM_SPRVAL":
+        img = array.array('B', img)
+        for (i, c) in enumerate(signature):
+            img[0x700 + i] = ord(c)
+    return img
+
+def moduletext(module, signature):
+    """ The Verilog for one entry of :func:`layout`, with the contents of :func:`moduleimage` """
+    (ramname, outer, inner, img, gen, indices) = module
+    img = moduleimage(module, signature)
+    if indices is None:
+        rams = inner.substitute(init = gen(img))
+    else:
+        rams = "".join([inner.substitute(i = i, init = gen(img, i)) for i in indices])
+    return outer.substitute(ramname = ramname, rams = rams) + "\n"
+
+def moduledigest(module):
+    # Hash of everything a module's text depends on, apart from the signature
+    (ramname, outer, inner, img, gen, indices) = module
+    h = hashlib.sha1()
+    for part in (ramname, outer.template, inner.template, gen.__name__, repr(indices), img.tostring()):
+        h.update("%d:" % len(part))
+        h.update(part)
+    return h.hexdigest()
+
+def svnrevision():
+    try:
+        return subprocess.Popen("svnversion", stdout=subprocess.PIPE).stdout.read().strip()
+    except OSError:
+        return "unknown"
+
+def buildsignature():
+    return ("Built %s from svn %s" % (time.ctime(), svnrevision())).ljust(64)
+
+def generate(mem, code, signature = None):
+    """
+    Return the whole of ``generated.v`` for memory image ``mem`` and J1 firmware ``code``,
+    both :class:`array.array` of type 'B'.
+    """
+    if signature is None:
+        signature = buildsignature()
+    return "".join([moduletext(m, signature) for m in layout(mem, code)])
+
+def regenerate(mem, code, output, manifest = None, signature = None, force = False):
+    """
+    Bring file ``output`` up to date for memory image ``mem`` and J1 firmware ``code``.
+
+    :param manifest: name of the manifest file; default is ``output`` with ``.manifest`` appended
+    :param signature: build signature to put in RAM_SPRVAL; default is the time and svn revision
+    :param force: regenerate every module
+    :rtype: list of the names of the modules regenerated, empty if ``output`` was already up to date
+
+    A module is regenerated when its contents differ from those recorded in the manifest, or when
+    its text in ``output`` is not what the manifest recorded.  If any module is regenerated,
+    RAM_SPRVAL is too, so the signature always tells when ``output`` last changed.
+    The manifest records the signature, for :func:`writeimages`.
+    """
+    if manifest is None:
+        manifest = output + ".manifest"
+    try:
+        old = json.load(open(manifest))
+        previous = open(output).read()
+    except (IOError, ValueError):
+        (old, previous) = ({}, "")
+
+    modules = layout(mem, code)
+    texts = {}
+    stale = []
+    for m in modules:
+        name = m[0]
+        entry = old.get(name)
+        if not force and entry and entry["input"] == moduledigest(m):
+            text = previous[entry["offset"]:entry["offset"] + entry["length"]]
+            if hashlib.sha1(text).hexdigest() == entry["output"]:
+                texts[name] = text
+                continue
+        stale.append(name)
+    if not stale:
+        return []
+    if not "RAM_SPRVAL" in stale:
+        stale.append("RAM_SPRVAL")
+
+    if signature is None:
+        signature = buildsignature()
+    new = {}
+    offset = 0
+    for m in modules:
+        name = m[0]
+        if name in stale:
+            texts[name] = moduletext(m, signature)
+        new[name] = {"input": moduledigest(m),
+                     "output": hashlib.sha1(texts[name]).hexdigest(),
+                     "offset": offset,
+                     "length": len(texts[name])}
+        offset += len(texts[name])
+    new["RAM_SPRVAL"]["signature"] = signature
+
+    # Write through temporary files, so an interrupted run leaves the old output and manifest
+    for (filename, data) in ((output, "".join([texts[m[0]] for m in modules])),
+                             (manifest, json.dumps(new, indent = 2, sort_keys = True))):
+        f = open(filename + ".tmp", "w")
+        f.write(data)
+        f.close()
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(filename + ".tmp", filename)
+    return [m[0] for m in modules if m[0] in stale]
+
+# Memory images in other formats, for tools that load RAM contents from a file.
+# Each writer takes a file, the memory contents and the word size in bytes, and formats
+# the contents a block of rows at a time with numpy.
+
+CHUNK = 4096    # rows formatted at a time
+
+def hexrows(rows, prefix = "", suffix = "\n"):
+    # Each row of bytes as hex digits, between prefix and suffix
+    (n, k) = rows.shape
+    (p, s) = (len(prefix), len(suffix))
+    c = numpy.empty((n, p + 2 * k + s), numpy.uint8)
+    c[:, :p] = numpy.frombuffer(prefix, numpy.uint8)
+    c[:, p:p + 2 * k:2] = HEXDIGITS[rows >> 4]
+    c[:, p + 1:p + 2 * k:2] = HEXDIGITS[rows & 15]
+    c[:, p + 2 * k:] = numpy.frombuffer(suffix, numpy.uint8)
+    return c.tostring()
+
+def wordrows(data, width, bigendian):
+    # The words of data as rows of bytes, most significant first
+    a = image(data)
+    if len(a) % width:
+        a = numpy.concatenate([a, numpy.zeros(width - len(a) % width, numpy.uint8)])
+    rows = a.reshape(-1, width)
+    return rows if bigendian else rows[:, ::-1]
+
+def writemem(f, data, width = 1, bigendian = False):
+    """ ``data`` for ``$readmemh``: a word of ``width`` bytes in hex on each line, like prom.mem """
+    rows = wordrows(data, width, bigendian)
+    for i in range(0, len(rows), CHUNK):
+        f.write(hexrows(rows[i:i + CHUNK]))
+
+def writecoe(f, data, width = 1, bigendian = False):
+    """ ``data`` as a CORE Generator ``.coe`` file of words of ``width`` bytes """
+    rows = wordrows(data, width, bigendian)
+    f.write("memory_initialization_radix=16;\nmemory_initialization_vector=\n")
+    for i in range(0, len(rows) - 1, CHUNK):
+        f.write(hexrows(rows[i:min(i + CHUNK, len(rows) - 1)], "", ",\n"))
+    if len(rows):
+        f.write(hexrows(rows[-1:], "", ";\n"))
+    else:
+        f.write(";\n")
+
+def ihexrecords(kind, address, rows):
+    # Intel HEX records of type kind, one for each row of bytes, the first at address
+    (n, k) = rows.shape
+    addr = address + k * numpy.arange(n)
+    rec = numpy.column_stack([numpy.zeros(n, int) + k, addr >> 8, addr & 255, numpy.zeros(n, int) + kind, rows])
+    return hexrows(numpy.column_stack([rec, -rec.sum(axis = 1)]).astype(numpy.uint8), ":")
+
+def writeihex(f, data, width = 1, bigendian = False):
+    """
+    ``data`` as an Intel HEX file, 16 bytes to a record, with extended linear address records
+    past 64K.  Bytes are in memory order, whatever ``width`` and ``bigendian``.
+    """
+    a = image(data)
+    for base in range(0, len(a), 0x10000):
+        if base:
+            f.write(ihexrecords(4, 0, numpy.array([[base >> 24, (base >> 16) & 255]])))
+        seg = a[base:base + 0x10000]
+        n = len(seg) & ~15
+        for i in range(0, n, 16 * CHUNK):
+            f.write(ihexrecords(0, i, seg[i:min(i + 16 * CHUNK, n)].reshape(-1, 16)))
+        if n < len(seg):
+            f.write(ihexrecords(0, n, seg[n:].reshape(1, -1)))
+    f.write(":00000001FF\n")
+
+def writebin(f, data, width = 1, bigendian = False):
+    """ ``data`` as raw binary, in memory order """
+    f.write(buffer(data))
+
+FORMATS = {"mem": writemem, "coe": writecoe, "hex": writeihex, "bin": writebin}
+
+def writeimages(mem, code, directory, formats = ("mem",), signature = None, manifest = None):
+    """
+    Write the contents of each RAM module of :func:`layout` to ``directory``, as files
+    ``ramname.ext`` for each extension of :data:`FORMATS` in ``formats``.
+    Returns the names of the files written.
+
+    :param signature: build signature to put in RAM_SPRVAL, when there is no ``manifest``; default is the time and svn revision
+    :param manifest: name of the manifest written by :func:`regenerate` for the same ``mem`` and ``code``
+
+    With a manifest, RAM_SPRVAL gets the signature that is in ``generated.v``, and a file is only
+    written when its module's entry in the manifest has changed since the file was last written,
+    as recorded in ``images.manifest`` in ``directory``.
+    """
+    modules = layout(mem, code)
+    current = {}
+    if manifest is not None:
+        current = json.load(open(manifest))
+        for m in modules:
+            if current[m[0]]["input"] != moduledigest(m):
+                raise ValueError("%s in %s is not for these contents" % (m[0], manifest))
+        if "signature" in current["RAM_SPRVAL"]:
+            signature = str(current["RAM_SPRVAL"]["signature"])
+    if signature is None:
+        signature = buildsignature()
+    record = os.path.join(directory, "images.manifest")
+    try:
+        written = json.load(open(record))
+    except (IOError, ValueError):
+        written = {}
+
+    names = []
+    for m in modules:
+        digest = current.get(m[0], {}).get("output")
+        todo = [ext for ext in formats if digest is None or written.get("%s.%s" % (m[0], ext)) != digest or
+                not os.path.exists(os.path.join(directory, "%s.%s" % (m[0], ext)))]
+        if not todo:
+            continue
+        img = moduleimage(m, signature)
+        for ext in todo:
+            name = os.path.join(directory, "%s.%s" % (m[0], ext))
+            f = open(name, "wb")
+            FORMATS[ext](f, img)
+            f.close()
+            written["%s.%s" % (m[0], ext)] = digest
+            names.append(name)
+    if names and manifest is not None:
+        f = open(record, "w")
+        f.write(json.dumps(written, indent = 2, sort_keys = True))
+        f.close()
+    return names
+
+# Generic tiling: any depth and port widths, built from a catalogue of RAM primitives
+
+def log2(n):
+    # Address bits needed for n words
+    return max(0, int(n - 1).bit_length())
+
+def bus(parts, width):
+    # Verilog concatenation of (expression, bits) parts, least significant first, zero-padded to width
+    used = sum([b for (_, b) in parts])
+    parts = [(e, b) for (e, b) in parts if b] + ([("%d'b0" % (width - used), width - used)] if width > used else [])
+    return "{%s}" % ", ".join([e for (e, _) in reversed(parts)])
+
+def sliced(sig, lo, n):
+    return "%s[%d]" % (sig, lo) if n == 1 else "%s[%d:%d]" % (sig, lo + n - 1, lo)
+
+class Primitive(object):
+    """
+    A RAM primitive: ``name``, its data bits, the data widths it supports and how many
+    256-bit INIT parameters it takes.  Subclasses write an instance with :meth:`write`.
+    """
+    dual = True         # two read/write ports, synchronous read
+    busbits = None      # width of the data ports, if fixed
+    def __init__(self, name, bits, widths, initlines):
+        self.name = name
+        self.bits = bits
+        self.widths = widths
+        self.initlines = initlines
+
+    def depth(self, width):
+        return self.bits / width
+
+    def inits(self, f, digits):
+        # INIT parameters from the hex digits of the contents, least significant first
+        lines = []
+        for j in range(self.initlines):
+            lines.append(".INIT_%02X(256'h%s)" % (j, digits[64 * j:64 * (j + 1)][::-1]))
+        f.write(",\n      ".join(lines))
+
+class RAMB16_S(Primitive):
+    # Spartan-3 block RAM; widths of 8 and up have parity bits, left unused
+    def write(self, f, inst, wa, wb, digits, a, b):
+        def s(w):
+            return {8: 9, 16: 18, 32: 36}.get(w, w)
+        f.write("\n    RAMB16_S%d_S%d #(\n      " % (s(wa), s(wb)))
+        self.inits(f, digits)
+        f.write("\n    ) %s (\n" % inst)
+        for (p, w, c) in (("A", wa, a), ("B", wb, b)):
+            if w >= 8:
+                f.write("      .DIP%s(0),\n" % p)
+            f.write("      .DI%s(%s),\n      .WE%s(%s),\n      .EN%s(%s),\n      .CLK%s(%s),\n"
+                    "      .ADDR%s(%s),\n      .DO%s(%s),\n      .SSR%s(%s)%s\n" %
+                    (p, c["di"], p, c["we"], p, c["en"], p, c["clk"], p, c["addr"], p, c["do"], p, c["ssr"],
+                     ",\n" if p == "A" else ""))
+        f.write("      );\n")
+
+class RAMBWER(Primitive):
+    # Spartan-6 block RAM, RAMB16BWER or RAMB8BWER; byte addressing pads the address with zeros
+    def __init__(self, name, bits, widths, initlines, busbits, addrbits, ports):
+        Primitive.__init__(self, name, bits, widths, initlines)
+        self.busbits = busbits
+        self.addrbits = addrbits
+        self.ports = ports
+
+    def write(self, f, inst, wa, wb, digits, a, b):
+        def s(w):
+            return {8: 9, 16: 18, 32: 36}.get(w, w)
+        f.write("\n    %s #(\n      .DATA_WIDTH_A(%d),\n      .DATA_WIDTH_B(%d),\n" % (self.name, s(wa), s(wb)))
+        if self.name == "RAMB8BWER":
+            f.write("      .RAM_MODE(\"TDP\"),\n")
+        f.write("      ")
+        self.inits(f, digits)
+        f.write("\n    ) %s (\n" % inst)
+        lines = []
+        for (p, w, c) in (("A", wa, a), ("B", wb, b)):
+            pad = self.addrbits - log2(self.depth(w))
+            names = self.ports[p]
+            lines += [".%s(%s)" % (names["di"], bus([(c["di"], w)], self.busbits)),
+                      ".%s(0)" % names["dip"],
+                      ".%s(%s)" % (names["addr"], bus([("%d'b0" % pad, pad), (c["addr"], log2(self.depth(w)))], self.addrbits)),
+                      ".%s({%d{%s}})" % (names["we"], self.busbits / 8, c["we"]),
+                      ".%s(%s)" % (names["en"], c["en"]),
+                      ".%s(%s)" % (names["clk"], c["clk"]),
+                      ".%s(%s)" % (names["rst"], c["ssr"]),
+                      ".%s(1'b0)" % names["regce"],
+                      ".%s(%s)" % (names["do"], c["do"])]
+        f.write("      " + ",\n      ".join(lines) + "\n      );\n")
+
+class RAM128X1D(Primitive):
+    # Distributed RAM: one write port, asynchronous reads on both ports
+    dual = False
+    def write(self, f, inst, wa, wb, digits, a, b):
+        f.write("\n    RAM128X1D #(.INIT(128'h%s)) %s (\n" % (digits[::-1], inst))
+        f.write("      .D(%s),\n      .WE(%s),\n      .WCLK(%s),\n      .A(%s),\n      .DPRA(%s),\n"
+                "      .SPO(%s),\n      .DPO(%s));\n" % (a["di"], a["we"], a["clk"], a["addr"], b["addr"], a["do"], b["do"]))
+
+RAMB16_SPARTAN3 = RAMB16_S("RAMB16_S", 16384, [1, 2, 4, 8, 16, 32], 64)
+RAMB16BWER_SPARTAN6 = RAMBWER("RAMB16BWER", 16384, [1, 2, 4, 8, 16, 32], 64, 32, 14,
+    dict([(p, {"di": "DI" + p, "dip": "DIP" + p, "addr": "ADDR" + p, "we": "WE" + p, "en": "EN" + p,
+               "clk": "CLK" + p, "rst": "RST" + p, "regce": "REGCE" + p, "do": "DO" + p}) for p in "AB"]))
+RAMB8BWER_SPARTAN6 = RAMBWER("RAMB8BWER", 8192, [1, 2, 4, 8, 16], 32, 16, 13,
+    {"A": {"di": "DIADI", "dip": "DIPADIP", "addr": "ADDRAWRADDR", "we": "WEAWEL", "en": "ENAWREN",
+           "clk": "CLKAWRCLK", "rst": "RSTA", "regce": "REGCEA", "do": "DOADO"},
+     "B": {"di": "DIBDI", "dip": "DIPBDIP", "addr": "ADDRBRDADDR", "we": "WEBWEU", "en": "ENBRDEN",
+           "clk": "CLKBRDCLK", "rst": "RSTBRST", "regce": "REGCEBREGCE", "do": "DOBDO"}})
+RAM128X1D_DISTRIBUTED = RAM128X1D("RAM128X1D", 128, [1], 1)
+
+SPARTAN3 = [RAMB16_SPARTAN3]
+SPARTAN6 = [RAMB16BWER_SPARTAN6, RAMB8BWER_SPARTAN6]
+DISTRIBUTED = [RAM128X1D_DISTRIBUTED]
+
+def tiling(depth, widtha, widthb = None, catalogue = SPARTAN3):
+    """
+    Choose how to build a memory of ``depth`` words of ``widtha`` bits on port A, ``widthb`` bits on port B,
+    from the primitives in ``catalogue``.
+
+    :rtype: tuple (count, rows, columns, primitive, wa, wb): the memory is ``rows`` primitives deep and
+        ``columns`` wide, each using data widths ``wa`` and ``wb``
+
+    The tiling with fewest primitives wins; among those, the one with fewest rows, so
+    the least output multiplexing, then the smallest primitive.
+    Port B must be at least as wide as port A.
+    """
+    if widthb is None:
+        widthb = widtha
+    assert widthb % widtha == 0, "port B width must be a multiple of port A width"
+    ratio = widthb / widtha
+    best = None
+    for (order, p) in enumerate(catalogue):
+        for wa in p.widths:
+            if not (wa * ratio) in p.widths or (ratio != 1 and not p.dual):
+                continue
+            columns = (widtha + wa - 1) / wa
+            rows = (depth + p.depth(wa) - 1) / p.depth(wa)
+            choice = (columns * rows, rows, p.bits, order, columns, p, wa, wa * ratio)
+            if best is None or choice[:4] < best[:4]:
+                best = choice
+    if best is None:
+        raise ValueError("no primitive in the catalogue can build %d x %d/%d" % (depth, widtha, widthb))
+    (count, rows, _, _, columns, p, wa, wb) = best
+    return (count, rows, columns, p, wa, wb)
+
+def writeram(f, ramname, contents, depth, widtha, widthb = None, catalogue = SPARTAN3):
+    """
+    Write a Verilog module ``ramname`` for a memory of ``depth`` words of ``widtha`` bits, with contents
+    ``contents``, a sequence of up to ``depth`` port A words.  Returns the :func:`tiling` used.
+
+    Block RAM modules have ports ``clka``, ``ena``, ``wea``, ``ssra``, ``addra``, ``dia`` and ``doa``, and the same for B;
+    port B words are ``widthb / widtha`` port A words, the lowest address in the low bits.
+    Distributed RAM modules have ports ``wclk``, ``wea``, ``ad``, ``a``, ``b``, ``ao`` and ``bo``, outputs registered,
+    like RAM_CODEL.  Each primitive's INIT parameters are computed and written as it is reached,
+    so memories of any size are streamed to ``f``.
+    """
+    if widthb is None:
+        widthb = widtha
+    (count, rows, columns, p, wa, wb) = tiling(depth, widtha, widthb, catalogue)
+    ratio = widthb / widtha
+    (aw, bw) = (log2(depth), log2(depth / ratio))
+    (pa, pb) = (log2(p.depth(wa)), log2(p.depth(wb)))
+    words = numpy.zeros(rows * p.depth(wa), numpy.uint64)
+    c = numpy.asarray(contents, numpy.uint64)
+    assert len(c) <= depth
+    words[:len(c)] = c
+
+    if p.dual:
+        f.write("\nmodule %s (\n" % ramname)
+        for x in "ab":
+            (w, n) = ((widtha, aw) if x == "a" else (widthb, bw))
+            f.write("    input clk%s,\n    input en%s,\n    input we%s,\n    input ssr%s,\n" % (x, x, x, x))
+            f.write("    input [%d:0] addr%s,\n    input [%d:0] di%s,\n    output [%d:0] do%s%s\n" %
+                    (max(n, 1) - 1, x, w - 1, x, w - 1, x, "," if x == "a" else ""))
+        f.write("    );\n")
+        names = {"a": dict(clk = "clka", en = "ena", we = "wea", ssr = "ssra", addr = "addra", di = "dia", do = "doa"),
+                 "b": dict(clk = "clkb", en = "enb", we = "web", ssr = "ssrb", addr = "addrb", di = "dib", do = "dob")}
+    else:
+        f.write("\nmodule %s (\n  input wclk,\n  input [%d:0] ad,\n  input wea,\n  input [%d:0] a,\n  input [%d:0] b,\n"
+                "  output reg [%d:0] ao,\n  output reg [%d:0] bo\n  );\n" % (ramname, widtha - 1, aw - 1, aw - 1, widtha - 1, widtha - 1))
+        names = {"a": dict(clk = "wclk", en = "1'b1", we = "wea", ssr = "1'b0", addr = "a", di = "ad", do = "ao"),
+                 "b": dict(clk = "wclk", en = "1'b1", we = "1'b0", ssr = "1'b0", addr = "b", di = "ad", do = "bo")}
+
+    n = 0
+    for r in range(rows):
+        for x in "ab":
+            f.write("  wire [%d:0] %s_r%d;\n" % ((widtha if x == "a" else widthb) - 1, names[x]["do"], r))
+        for col in range(columns):
+            # this primitive holds bits col*wa.. of every port A word in rows r*depth..
+            bits = min(wa, widtha - col * wa)
+            vals = (words[r * p.depth(wa):(r + 1) * p.depth(wa)] >> numpy.uint64(col * wa)) & numpy.uint64((1 << wa) - 1)
+            image = ((vals[:, None] >> numpy.arange(wa, dtype = numpy.uint64)) & numpy.uint64(1)).astype(numpy.uint8)
+            nibbles = image.reshape(-1, 4).dot(numpy.array([1, 2, 4, 8], numpy.uint8))
+            digits = HEXDIGITS[nibbles].tostring()
+
+            conn = {}
+            for (x, pw, addrbits, memaddr) in (("a", wa, pa, aw), ("b", wb, pb, bw)):
+                nm = names[x]
+                w = widtha if x == "a" else widthb
+                groups = [(j * widtha + col * wa, bits) for j in range(pw / wa)]
+                f.write("  wire [%d:0] _%s%d;\n" % ((p.busbits or pw) - 1, nm["do"], n))
+                for (j, (lo, nb)) in enumerate(groups):
+                    f.write("  assign %s = %s;\n" % (sliced("%s_r%d" % (nm["do"], r), lo, nb), sliced("_%s%d" % (nm["do"], n), j * wa, nb)))
+                we = nm["we"]
+                if rows > 1 and we != "1'b0":
+                    we = "%s & (%s == %d)" % (we, sliced(nm["addr"], addrbits, memaddr - addrbits), r)
+                addr = bus([(sliced(nm["addr"], 0, min(addrbits, memaddr)), min(addrbits, memaddr))], addrbits)
+                conn[x] = dict(nm, we = we, addr = addr, do = "_%s%d" % (nm["do"], n),
+                               di = bus([(sliced(nm["di"], lo, nb), wa) if nb == wa else (bus([(sliced(nm["di"], lo, nb), nb)], wa), wa)
+                                         for (lo, nb) in groups], pw))
+            p.write(f, "ram%d" % n, wa, wb, digits, conn["a"], conn["b"])
+            n += 1
+
+    # Pick the row's output by the address, registered like the block RAM output
+    for x in "ab":
+        nm = names[x]
+        memaddr = aw if x == "a" else bw
+        addrbits = pa if x == "a" else pb
+        if p.dual:
+            out = nm["do"]
+            if rows == 1:
+                f.write("  assign %s = %s_r0;\n" % (out, out))
+                continue
+            f.write("  reg [%d:0] %s_row;\n  always @(posedge %s)\n    if (%s)\n      %s_row <= %s;\n" %
+                    (memaddr - addrbits - 1, x, nm["clk"], nm["en"], x, sliced(nm["addr"], addrbits, memaddr - addrbits)))
+            sel = "%s_row" % x
+            f.write("  assign %s = " % out)
+        else:
+            sel = sliced(nm["addr"], addrbits, memaddr - addrbits) if rows > 1 else None
+            f.write("  always @(posedge wclk)\n    %so <= " % x)
+        f.write("".join(["(%s == %d) ? %s_r%d : " % (sel, r, nm["do"], r) for r in range(rows - 1)]))
+        f.write("%s_r%d;\n" % (nm["do"], rows - 1))
+    f.write("endmodule\n")
+    return (count, rows, columns, p, wa, wb)
+
+# Patching block RAM contents straight into a Spartan-6 .bit file, without running ISE
+
+# Configuration registers and commands
+(CRC, FDRI, CMD) = (0x00, 0x03, 0x05)
+RCRC = 0x0007
+DESYNC = 0x000d
+CRCPOLY = 0x409081      # x^22 + x^15 + x^12 + x^7 + 1
+
+# Parts whose block RAM frames are known: the frame where they start in the FDRI data,
+# the number of block RAM columns and of rows of 4 RAMB16s each
+BRAMLAYOUT = {"6slx25": (5065, 3, 5)}
+FRAMEWORDS = 65
+BRAMWORDS = 18 * FRAMEWORDS     # one RAMB16
+
+# Instance names in gameduino.v of the modules of generated.v
+INSTANCES = {"RAM_SPRIMG": "sprimg", "RAM_PICTURE": "picture", "RAM_CHR": "chars",
+             "RAM_PAL": "charpalette", "RAM_SPRVAL": "sprval", "RAM_SPRPAL": "sprpal"}
+
+def crc22(crc, reg, data):
+    """ The configuration CRC ``crc`` after writing the words ``data`` to register ``reg`` """
+    r = reg << 16
+    for d in data:
+        crc <<= 1
+        if crc & 0x400000:
+            crc ^= CRCPOLY
+        crc ^= r | d
+    return crc
+
+def braminit(width):
+    """
+    Bit positions, within a RAMB16's 18 frames, of its 16384 INIT bits for port width ``width``.
+    Each 18-bit slot holds 16 data bits, highest first, and 2 parity bits.  At 32 bits wide
+    the low and high halves of each word are in the two halves of the RAM.
+    """
+    k = numpy.arange(16384)
+    if width >= 32:
+        k = (k & 16) * 512 + (k >> 5) * 16 + (k & 15)
+    return 161 + 18 * (k >> 4) - (k & 15)
+
+class Bitstream(object):
+    """
+    A Spartan-6 ``.bit`` file, ``data``, for reading and rewriting the contents of its block RAMs.
+    Sites are (x, y) of the RAMB16 site names, as in the PLACED annotations of a BMM file.
+    """
+    def __init__(self, data):
+        self.fields = {}
+        i = 13
+        while data[i] != "e":
+            (n,) = struct.unpack(">H", data[i + 1:i + 3])
+            self.fields[data[i]] = data[i + 3:i + 3 + n].rstrip("\0")
+            i += 3 + n
+        self.head = data[:i + 5]
+        self.words = numpy.frombuffer(data[i + 5:], ">u2").astype(numpy.uint16)
+        self.sync = 0
+        while (self.words[self.sync], self.words[self.sync + 1]) != (0xaa99, 0x5566):
+            self.sync += 1
+        part = [p for p in BRAMLAYOUT if self.fields["b"].startswith(p)]
+        if not part:
+            raise ValueError("no block RAM layout for part %s" % self.fields["b"])
+        (start, self.columns, self.rows) = BRAMLAYOUT[part[0]]
+        (n, i) = max([(n, i) for (reg, i, n) in self.writes() if reg == FDRI])
+        self.bram = i + start * FRAMEWORDS
+
+    def writes(self):
+        """
+        (register, index of the first data word, word count) of each register write,
+        up to the DESYNC command that ends the configuration data
+        """
+        w = self.words
+        i = self.sync + 2
+        while i < len(w):
+            h = int(w[i])
+            (kind, op, reg, n) = (h >> 13, (h >> 11) & 3, (h >> 5) & 0x3f, h & 0x1f)
+            i += 1
+            if kind == 2:
+                n = (int(w[i]) << 16) | int(w[i + 1])
+                i += 2
+            elif kind != 1:
+                raise ValueError("bad packet header %04x at word %d" % (h, i - 1))
+            if op == 2:
+                yield (reg, i, n)
+                if reg == CMD and n and w[i] == DESYNC:
+                    return      # anything after is padding, not packets
+            i += n
+            if op == 2 and reg == FDRI:
+                i += 2          # the CRC that follows FDRI data
+
+    def crc(self, fix = False):
+        """
+        Check the CRC values in the configuration data, or with ``fix`` set, rewrite them
+        to match it.  Returns the number that were wrong.
+        """
+        w = self.words
+        crc = 0
+        bad = 0
+        for (reg, i, n) in self.writes():
+            if reg == CMD and w[i] == RCRC:
+                crc = 0
+                continue
+            if reg != CRC:
+                crc = crc22(crc, reg, w[i:i + n].tolist())
+                if reg != FDRI:
+                    continue
+                i += n
+            if (int(w[i]) << 16) | int(w[i + 1]) != crc:
+                bad += 1
+                if fix:
+                    w[i:i + 2] = (crc >> 16, crc & 0xffff)
+        return bad
+
+    def sites(self):
+        return [(x, y) for y in range(0, 8 * self.rows, 2) for x in range(self.columns)]
+
+    def span(self, site):
+        # The words holding the RAMB16 at site
+        (x, y) = site
+        if not site in self.sites():
+            raise ValueError("no RAMB16 site X%dY%d" % site)
+        s = self.bram + BRAMWORDS * (4 * self.columns * (y / 8) + 4 * x + (y % 8) / 2)
+        return slice(s, s + BRAMWORDS)
+
+    def read(self, site, width):
+        """ The 16384 INIT bits of the RAMB16 at ``site``, used with port width ``width`` """
+        bits = numpy.unpackbits(self.words[self.span(site)].astype(">u2").view(numpy.uint8))
+        return bits[braminit(width)]
+
+    def write(self, site, bits, width):
+        """ Set the INIT bits of the RAMB16 at ``site``.  The CRCs are fixed by :meth:`crc`. """
+        s = self.span(site)
+        block = numpy.unpackbits(self.words[s].astype(">u2").view(numpy.uint8))
+        block[braminit(width)] = bits
+        self.words[s] = numpy.packbits(block).view(">u2")
+
+    def tostring(self):
+        return self.head + self.words.astype(">u2").tostring()
+
+def brams(text):
+    """
+    The RAMB16s in Verilog ``text``, as written by :func:`generate` or :func:`writeram`: a list of
+    (name, width, bits), where name is "module instance/RAM instance" for modules of
+    generated.v, as in :data:`INSTANCES`, and "module/RAM instance" otherwise, width is that of
+    the wider port and bits are the 16384 INIT bits.
+    """
+    r = []
+    for (module, body) in re.findall(r"module (\w+)\s*\((.*?)endmodule", text, re.S):
+        for (prim, params, inst) in re.findall(r"(RAMB16\w*) #\((.*?)\) (\w+) \(", body, re.S):
+            width = max([int(w) for w in re.findall(r"_S(\d+)", prim) + re.findall(r"DATA_WIDTH_[AB]\((\d+)\)", params)])
+            bits = numpy.zeros(16384, numpy.uint8)
+            for (j, base, v) in re.findall(r"\.INIT_([0-9A-F]{2})\(256'([bh])(\w+)\)", params):
+                digits = numpy.frombuffer(v[::-1].upper(), numpy.uint8)
+                if base == "b":
+                    b = digits - ord('0')
+                else:
+                    b = (numpy.searchsorted(HEXDIGITS, digits)[:, None] >> numpy.arange(4)).ravel() & 1
+                bits[256 * int(j, 16):256 * int(j, 16) + len(b)] = b
+            r.append(("%s/%s" % (INSTANCES.get(module, module), inst), width, bits))
+    return r
+
+def readbmm(text):
+    """
+    The RAMs of BMM file ``text``, such as the ``_bd.bmm`` file written by bitgen: a list of
+    (instance, address, bus bytes, msb, lsb, depth, little endian, site) for each bit lane,
+    where address is that of the lane's first word, and site comes from its PLACED annotation,
+    or is None.  Bus blocks follow each other in their address space.
+    """
+    r = []
+    little = False
+    for line in re.sub(r"//.*", "", text).split(";"):
+        words = line.split()
+        if "ADDRESS_MAP" in words:
+            little = words[words.index("ADDRESS_MAP") + 2].endswith("-LE")
+        if "ADDRESS_SPACE" in words:
+            address = int(re.search(r"\[(\w+):", line).group(1), 16)
+        if "BUS_BLOCK" in words:
+            lanes = []
+        m = re.search(r"([\w/.\[\]]+)\s+(?:RAMB\w*\s+)?\[(\d+):(\d+)\](?:\s*\[(\d+):(\d+)\])?", line.split("BUS_BLOCK")[-1])
+        if m and not "END_BUS_BLOCK" in words:
+            (inst, msb, lsb, first, last) = m.groups()
+            (msb, lsb) = (int(msb), int(lsb))
+            depth = int(last) - int(first) + 1 if last else 16384 / (msb - lsb + 1)
+            placed = re.search(r"PLACED\s*=\s*X(\d+)Y(\d+)", line)
+            lanes.append([inst, msb, lsb, depth, placed and (int(placed.group(1)), int(placed.group(2)))])
+        if "END_BUS_BLOCK" in words:
+            nbytes = sum([msb - lsb + 1 for (_, msb, lsb, _, _) in lanes]) / 8
+            for (inst, msb, lsb, depth, site) in lanes:
+                r.append((inst, address, nbytes, msb, lsb, depth, little, site))
+            address += nbytes * max([l[3] for l in lanes])
+    return r
+
+def bmmbrams(lanes, image):
+    """
+    Contents for the RAMs in :func:`readbmm` ``lanes``, from ``image``, a string of the memory's
+    bytes from address 0; addresses past its end read as zero.  A list of (instance, width, bits).
+    """
+    a = numpy.frombuffer(image, numpy.uint8)
+    r = []
+    for (inst, address, nbytes, msb, lsb, depth, little, site) in lanes:
+        words = numpy.zeros(depth * nbytes, numpy.uint8)
+        part = a[address:address + len(words)]
+        words[:len(part)] = part
+        words = words.reshape(depth, nbytes)
+        if not little:
+            words = words[:, ::-1]
+        # each word's bits, least significant first
+        wordbits = numpy.unpackbits(words[:, :, None], axis = 2)[:, :, ::-1].reshape(depth, 8 * nbytes)
+        bits = numpy.zeros(16384, numpy.uint8)
+        lane = wordbits[:, lsb:msb + 1].ravel()
+        bits[:len(lane)] = lane
+        r.append((inst, msb - lsb + 1, bits))
+    return r
+
+def elfimage(data):
+    """ The memory image, from address 0, of the loadable segments of 32-bit ELF file ``data`` """
+    e = "<" if data[5] == "\x01" else ">"
+    (phoff,) = struct.unpack(e + "I", data[28:32])
+    (phentsize, phnum) = struct.unpack(e + "HH", data[42:46])
+    segments = []
+    for i in range(phnum):
+        (kind, offset, vaddr, paddr, size) = struct.unpack(e + "5I", data[phoff + i * phentsize:][:20])
+        if kind == 1 and size:
+            segments.append((paddr, data[offset:offset + size]))
+    image = bytearray(max([a + len(s) for (a, s) in segments] + [0]))
+    for (a, s) in segments:
+        image[a:a + len(s)] = s
+    return str(image)
+
+def locate(bit, rams):
+    """
+    Find ``rams``, a list of (name, width, bits), in :class:`Bitstream` ``bit`` by their contents.
+    Returns {name: site}.  A RAM whose contents are at no site, or at more than one, is an error.
+    """
+    contents = {}
+    placements = {}
+    for (name, width, bits) in rams:
+        wide = width >= 32
+        if not wide in contents:
+            contents[wide] = [(s, bit.read(s, width)) for s in bit.sites()]
+        found = [s for (s, b) in contents[wide] if numpy.array_equal(b, bits)]
+        if len(found) != 1:
+            raise ValueError("%s is at %d sites in the bitstream, not 1; use a BMM file to place it" % (name, len(found)))
+        placements[name] = found[0]
+    return placements
+
+def patchbit(data, rams, placements):
+    """
+    Write ``rams``, a list of (name, width, bits), into the block RAMs of .bit file ``data``
+    at the sites given by ``placements``, {name: (x, y)}, and fix the CRCs.  Only the frames of
+    those RAMs and the CRC words change.
+    Returns the new .bit file and the names of the RAMs whose contents changed.
+    """
+    bit = Bitstream(data)
+    if bit.crc():
+        raise ValueError("the bitstream's own CRCs do not check")
+    changed = []
+    for (name, width, bits) in rams:
+        if not name in placements:
+            raise ValueError("no placement for %s" % name)
+        if not numpy.array_equal(bit.read(placements[name], width), bits):
+            bit.write(placements[name], bits, width)
+            changed.append(name)
+    bit.crc(fix = True)
+    return (bit.tostring(), changed)
+
+def main(argv):
+    (opts, args) = getopt.getopt(argv, "m:j:o:s:fb:p:", ["mem=", "j1=", "output=", "manifest=", "signature=", "force",
+                                                       "bit=", "patch=", "bmm=", "firmware=", "images=", "formats="])
+    opts = dict(opts)
+    def opt(short, long, default):
+        return opts.get(short, opts.get(long, default))
+    mem = array.array('B', open(opt("-m", "--mem", "sketches/proto/cold.dump"), "rb").read())
+    code = array.array('B', open(opt("-j", "--j1", "sketches/j1firmware/cold.binbe"), "rb").read())
+    output = opt("-o", "--output", "../verilog/generated.v")
+    signature = opt("-s", "--signature", None)
+    if signature is not None:
+        signature = signature.ljust(64)
+    (bitfile, patched) = (opt("-b", "--bit", None), opt("-p", "--patch", None))
+    if bitfile and not patched:
+        sys.exit("genrams: -b needs -p, the .bit file to write")
+    # What the bitstream was built from: the generated.v before this run, if there is one
+    reference = None
+    if bitfile and os.path.exists(output):
+        reference = open(output).read()
+    done = regenerate(mem, code, output, opts.get("--manifest"), signature,
+                      "-f" in opts or "--force" in opts)
+    if done:
+        print "%s: regenerated %s" % (output, " ".join(done))
+    else:
+        print "%s: up to date" % output
+    if "--images" in opts:
+        formats = opts.get("--formats", "mem").split(",")
+        written = writeimages(mem, code, opts["--images"], formats, signature, opts.get("--manifest", output + ".manifest"))
+        print "%s: wrote %d files" % (opts["--images"], len(written))
+
+    if bitfile:
+        data = open(bitfile, "rb").read()
+        lanes = readbmm(open(opts["--bmm"]).read()) if "--bmm" in opts else []
+        placed = dict([(l[0], l[-1]) for l in lanes if l[-1]])
+        # The RAMs of generated.v are placed by the BMM file if it names them, otherwise
+        # found in the bitstream by their contents in the old generated.v
+        placements = {}
+        unplaced = []
+        rams = brams(open(output).read())
+        for ram in brams(reference) if reference is not None else rams:
+            sites = [s for (inst, s) in placed.items() if inst.endswith("/" + ram[0])]
+            if sites:
+                placements[ram[0]] = sites[0]
+            else:
+                unplaced.append(ram)
+        placements.update(locate(Bitstream(data), unplaced))
+        if "--firmware" in opts:
+            image = open(opts["--firmware"], "rb").read()
+            if image.startswith("\x7fELF"):
+                image = elfimage(image)
+            names = ["/" + r[0] for r in rams]
+            firmware = [l for l in lanes if l[-1] and not [n for n in names if l[0].endswith(n)]]
+            rams += bmmbrams(firmware, image)
+            placements.update(placed)
+        (data, changed) = patchbit(data, rams, placements)
+        open(patched, "wb").write(data)
+        print "%s: patched %s" % (patched, " ".join(changed) or "nothing")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
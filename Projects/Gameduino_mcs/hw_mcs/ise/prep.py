@@ -67,6 +67,8 @@ The module defines these constants for use as the ``palset`` argument to  :meth:
 
 """
 
+__version__ = "0.2"
+
 PALETTE256A = [0]
 PALETTE256B = [1]
 PALETTE256C = [2]
@@ -91,8 +93,21 @@ PALETTE16B = (PALETTE16B_BITS0123, PALETTE16B_BITS4567)
 
 from array import array
 import Image
-
-def dump(hh, name, data):
+import numpy
+import multiprocessing
+import mmap
+import StringIO
+import itertools
+import weakref
+import os
+import hashlib
+import zlib
+import cPickle
+import wave
+
+hexbytes = ["0x%02x, " % c for c in range(256)]
+
+def dump(hh, name, data, codec = None):
     """
     Writes data to a header file for use in an Arduino Sketch.
 
@@ -102,16 +117,241 @@ def dump(hh, name, data):
     :type name: string
     :param data: the data to be dumped
     :type data: :class:`array.array`
+    :param codec: None to write the data as it is, otherwise a codec for :func:`compress`, or "auto"
+
+    When compressed, the header also gets ``NAME_CODEC`` and ``NAME_SIZE``, the unpacked size in bytes,
+    and, the first time a codec is used with ``hh``, the code in :data:`UNPACK`.  The sketch unpacks with::
+
+        gd_unpack(RAM_CHR, title_chr, TITLE_CHR_CODEC, TITLE_CHR_SIZE);
     """
-    print >>hh, "static PROGMEM prog_uchar %s[] = {" % name
-    bb = array('B', data.tostring())
+    bb = bytearray(buffer(data))
+    if codec is not None:
+        (codec, packed) = compress(bb, codec)
+        try:
+            first = not hh in unpacked
+            unpacked[hh] = True
+        except TypeError:
+            first = True        # cannot remember hh, but the guard in UNPACK makes repeats harmless
+        if first:
+            hh.write(UNPACK)
+        print >>hh, "// %s: %s, %d bytes packed to %d" % (name, codec, len(bb), len(packed))
+        print >>hh, "#define %s_CODEC %d" % (name.upper(), CODECS.index(codec))
+        print >>hh, "#define %s_SIZE %d" % (name.upper(), len(bb))
+        bb = bytearray(packed)
+    text = ["static PROGMEM prog_uchar %s[] = {\n" % name]
     for i in range(0, len(bb), 16):
         if (i & 0xff) == 0:
-            print >>hh
-        for c in bb[i:i+16]:
-            print >>hh, "0x%02x, " % c,
-        print >>hh
-    print >>hh, "};"
+            text.append("\n")
+        text.append(" ".join([hexbytes[c] for c in bb[i:i+16]]))
+        text.append("\n")
+    text.append("};\n")
+    hh.write("".join(text))
+
+# Compressed streams are a sequence of tokens.  A token byte t < 128 is followed by t + 1 literal bytes.
+# Otherwise, for "rle" the next byte is repeated t - 126 times; for "lz", t - 125 bytes are
+# copied from the output starting the next byte plus one back.  The bytes copied never
+# overlap the bytes written, so the decoder can read them all before writing.
+CODECS = ["raw", "rle", "lz"]
+
+# Header files that have had UNPACK written to them
+unpacked = weakref.WeakKeyDictionary()
+
+UNPACK = """\
+#ifndef GD_UNPACK
+#define GD_UNPACK
+static void gd_unpack(unsigned int addr, prog_uchar *src, byte codec, unsigned int size)
+{
+  if (codec == 0) {
+    GD.copy(addr, src, size);
+    return;
+  }
+  unsigned int end = addr + size;
+  while (addr < end) {
+    byte t = pgm_read_byte_near(src++);
+    if (t < 128) {
+      GD.copy(addr, src, t + 1);
+      src += t + 1;
+      addr += t + 1;
+    } else if (codec == 1) {
+      byte n = t - 126;
+      GD.fill(addr, pgm_read_byte_near(src++), n);
+      addr += n;
+    } else {
+      byte n = t - 125, i, buf[130];
+      GD.__start(addr - 1 - pgm_read_byte_near(src++));
+      for (i = 0; i < n; i++)
+        buf[i] = SPI.transfer(0);
+      GD.__end();
+      GD.__wstart(addr);
+      for (i = 0; i < n; i++)
+        SPI.transfer(buf[i]);
+      GD.__end();
+      addr += n;
+    }
+  }
+}
+#endif
+
+"""
+
+# Modelled AVR cycles for gd_unpack(): starting an SPI transfer, moving one byte
+# over SPI, and reading a token.  An "lz" copy is two transfers: a read and a write.
+CYCLES_START = 60
+CYCLES_BYTE = 20
+CYCLES_TOKEN = 12
+
+def literals(bb, i, j, out):
+    # Append the tokens for literal bytes bb[i:j] to out, return the modelled cycles
+    cycles = 0
+    for k in range(i, j, 128):
+        n = min(128, j - k)
+        out.append(n - 1)
+        out.extend(bb[k:k + n])
+        cycles += CYCLES_TOKEN + CYCLES_START + n * CYCLES_BYTE
+    return cycles
+
+def rle(bb):
+    # Run-length encode bb, return the stream and its modelled decode cycles
+    out = bytearray()
+    cycles = 0
+    lit = i = 0
+    while i < len(bb):
+        j = i + 1
+        while j < len(bb) and j - i < 129 and bb[j] == bb[i]:
+            j += 1
+        if j - i >= 3:
+            cycles += literals(bb, lit, i, out)
+            out.append(j - i + 126)
+            out.append(bb[i])
+            cycles += CYCLES_TOKEN + CYCLES_START + (j - i) * CYCLES_BYTE
+            lit = j
+        i = j
+    cycles += literals(bb, lit, len(bb), out)
+    return (out, cycles)
+
+def lz(bb):
+    # Greedy LZ77 over a 256-byte window, return the stream and its modelled decode cycles
+    out = bytearray()
+    cycles = 0
+    lit = i = 0
+    heads = {}      # 3-byte string -> positions where it starts, most recent last
+    data = str(bb)
+    while i < len(bb):
+        (best, dist) = (0, 0)
+        for p in reversed(heads.get(data[i:i + 3], [])):
+            if i - p > 256:
+                break
+            n = 0
+            while n < min(130, i - p) and i + n < len(bb) and bb[p + n] == bb[i + n]:
+                n += 1
+            if n > best:
+                (best, dist) = (n, i - p)
+                if n == 130:
+                    break
+        # A copy is slow to decode, so only take one that saves flash
+        if best >= 4:
+            cycles += literals(bb, lit, i, out)
+            out.append(best + 125)
+            out.append(dist - 1)
+            cycles += CYCLES_TOKEN + 2 * (CYCLES_START + best * CYCLES_BYTE)
+            step = best
+            lit = i + best
+        else:
+            step = 1
+        for k in range(i, min(i + step, len(bb) - 2)):
+            heads.setdefault(data[k:k + 3], []).append(k)
+        i += step
+    cycles += literals(bb, lit, len(bb), out)
+    return (out, cycles)
+
+def compress(data, codec = "auto", slowdown = 4.0):
+    """
+    Compress data for :func:`dump`.
+
+    :param data: the data to be compressed
+    :type data: :class:`array.array`
+    :param codec: one of ``"raw"``, ``"rle"``, ``"lz"``, or ``"auto"`` to choose
+    :param slowdown: for "auto", how many times slower than a plain copy unpacking may be, as modelled
+    :rtype: tuple (codec, packed data as :class:`array.array` of type 'B')
+
+    "auto" takes the smallest result whose modelled decode time on the Arduino is within ``slowdown``
+    times that of copying the data unpacked.
+    """
+    bb = bytearray(buffer(data))
+    raw = (bb, CYCLES_START + len(bb) * CYCLES_BYTE)
+    if codec == "auto":
+        choices = [("raw", raw), ("rle", rle(bb)), ("lz", lz(bb))]
+        choices = [(len(p), i, c, p) for (i, (c, (p, cycles))) in enumerate(choices) if cycles <= slowdown * raw[1] or c == "raw"]
+        (_, _, codec, packed) = min(choices)
+    elif codec == "raw":
+        packed = bb
+    else:
+        assert codec in CODECS, "unknown codec %s" % codec
+        (packed, _) = {"rle": rle, "lz": lz}[codec](bb)
+    return (codec, array('B', str(packed)))
+
+def decompress(codec, packed):
+    """
+    Reference decoder for :func:`compress`, doing what ``gd_unpack()`` in :data:`UNPACK` does.
+
+    :param codec: the codec, by name or by number
+    :param packed: packed data
+    :rtype: :class:`array.array` of type 'B'
+    """
+    if not isinstance(codec, str):
+        codec = CODECS[codec]
+    src = bytearray(buffer(packed))
+    if codec == "raw":
+        return array('B', str(src))
+    out = bytearray()
+    i = 0
+    while i < len(src):
+        t = src[i]
+        if t < 128:
+            out += src[i + 1:i + t + 2]
+            i += t + 2
+        elif codec == "rle":
+            out += bytearray([src[i + 1]]) * (t - 126)
+            i += 2
+        else:
+            start = len(out) - 1 - src[i + 1]
+            out += out[start:start + t - 125]
+            i += 2
+    return array('B', str(out))
+
+def dumpbin(f, data):
+    """
+    Writes the raw bytes of data to a binary file, straight from its buffer.
+
+    :param f: destination file, opened in binary mode
+    :type f: :class:`file`
+    :param data: the data to be written
+    :type data: :class:`array.array`
+    """
+    f.write(buffer(data))
+
+def dumpmmap(filename, data):
+    """
+    Writes the raw bytes of data to file ``filename`` through a memory map.
+    Returns the :class:`mmap.mmap`, so the caller can patch the file in place; close it when done.
+
+    :param filename: name of the destination file, which is created or truncated
+    :param data: the data to be written
+    :type data: :class:`array.array`
+    """
+    b = buffer(data)
+    f = open(filename, "w+b")
+    try:
+        f.truncate(len(b))
+        if len(b) == 0:
+            return None
+        m = mmap.mmap(f.fileno(), len(b))
+    finally:
+        f.close()
+    m.write(b)
+    m.seek(0)
+    m.flush()
+    return m
 
 def rgbpal(imdata):
     # For RGBA imdata, return list of (r,g,b) triples and the palette
@@ -123,17 +363,57 @@ def rgbpal(imdata):
 def getch(im, x, y):
     # return the RGBA data for the 8x8 character at (x, y) in im
     # if the 8x8 RGB contains more than 4 colors, quantize it using
-    # `scolorq <http://www.cs.berkeley.edu/~dcoetzee/downloads/scolorq/>`_.
+    # :func:`quantize4`.
 
     sub88 = im.crop((x, y, x + 8, y + 8))
     sub88d = sub88.tostring()
 
     (_, pal) = rgbpal(sub88d)
     if len(pal) > 4:
-        return sub88.convert('RGB').convert('P', palette=Image.ADAPTIVE, colors=4).convert("RGBA")
+        rgb = numpy.frombuffer(sub88.convert('RGB').tostring(), numpy.uint8).reshape(1, 64, 3)
+        return Image.fromstring('RGB', (8, 8), quantize4(rgb).tostring()).convert("RGBA")
     else:
         return sub88
 
+def quantize4(rgb):
+    """
+    Reduce each of a batch of 8x8 cells to at most 4 colors.
+
+    :param rgb: cell pixels, a :class:`numpy.ndarray` of shape (N, 64, 3) and type uint8
+    :rtype: :class:`numpy.ndarray` of the same shape, each cell using at most 4 colors
+
+    All cells are quantized together by a two-level median cut, which splits
+    every cell's pixels into 4 boxes of 16 and gives each box its mean color.
+    The result depends only on the input, so rebuilds are byte-stable.
+    """
+    n = len(rgb)
+    planes = numpy.ascontiguousarray(rgb.transpose(0, 2, 1)).reshape(3 * n, 64)
+    base = 3 * numpy.arange(n)                          # row of each box's red plane
+    where = numpy.arange(64, dtype = numpy.uint16)      # pixels in each box
+    vals = planes.reshape(n, 3, 64)
+    for level in range(2):
+        # Split each box at the median of its widest channel.  The sort key
+        # carries the pixel number, so keys are unique and the split is exact.
+        ch = (vals.max(axis = 2) - vals.min(axis = 2)).argmax(axis = 1)
+        key = (vals[numpy.arange(len(base)), ch].astype(numpy.uint16) << 6) | where
+        key.partition(key.shape[1] / 2 - 1, axis = 1)
+        where = (key & 63).reshape(2 * len(base), -1)
+        base = numpy.repeat(base, 2)
+        vals = planes[base[:, None, None] + numpy.arange(3)[:, None], where[:, None, :]]
+    centers = ((vals.sum(axis = 2, dtype = numpy.uint16) + 8) >> 4).astype(numpy.uint8)
+    out = numpy.empty((n, 64, 3), numpy.uint8)
+    out[(base / 3)[:, None], where] = centers[:, None, :]
+    return out
+
+def cells(im):
+    """
+    Return the pixels of RGBA image im as a writable :class:`numpy.ndarray` of
+    shape (cells, 8, 8, 4), one 8x8 character cell per entry in raster order.
+    """
+    (w, h) = im.size
+    a = numpy.frombuffer(im.tostring(), numpy.uint8).reshape(h / 8, 8, w / 8, 8, 4)
+    return numpy.array(a.swapaxes(1, 2)).reshape(-1, 8, 8, 4)
+
 def rgb555(r, g, b):
     return ((r / 8) << 10) + ((g / 8) << 5) + (b / 8)
 
@@ -148,18 +428,37 @@ def encodech(imdata):
     """
 
     assert len(imdata) == (4 * 8 * 8)
-    (rgbs, palette) = rgbpal(imdata)
-    indices = [palette.index(c) for c in rgbs]
-    indices_b = ""
-    for i in range(0, len(indices), 4):
-        c =   ((indices[i] << 6) +
-               (indices[i + 1] << 4) +
-               (indices[i + 2] << 2) +
-               (indices[i + 3]))
-        indices_b += (chr(c))
-    palette = (palette + ([(0,0,0,255)] * 4))[:4]   # unused palette entries: opaque black
-    ph = array('H', [rgba1555(*p) for p in palette])
-    return (indices_b, ph)
+    (cd, pd) = encodechars(numpy.frombuffer(imdata, numpy.uint32).reshape(1, 64))
+    return (cd.tostring(), pd)
+
+def encodechars(glyphs):
+    """
+    glyphs is a (n, 64) :class:`numpy.ndarray` of 32-bit RGBA pixels, one 8x8 character per row,
+    each using at most 4 colors.
+    Return the character and palette data for all of them in one pass, as
+    :class:`array.array` of type 'B' (16 bytes per character) and 'H' (4 entries per character).
+    """
+
+    # Each glyph's palette lists its colors in the same order as rgbpal(),
+    # so only the first occurrence of each color goes into the set.
+    ng = len(glyphs)
+    earlier = numpy.tril(numpy.ones((64, 64), bool), -1)
+    firstuse = ~((glyphs[:, :, None] == glyphs[:, None, :]) & earlier).any(axis = 2)
+    rgbas = glyphs.view(numpy.uint8).reshape(ng, 64, 4)
+    pals = numpy.empty((ng, 4, 4), numpy.uint8)
+    pals[:] = (0, 0, 0, 255)    # unused palette entries: opaque black
+    for i in range(ng):
+        palette = list(set(tuple(c) for c in rgbas[i][firstuse[i]].tolist()))
+        pals[i, :len(palette)] = palette
+
+    # 2-bit index planes, four pixels per byte, most significant first
+    indices = (glyphs[:, :, None] == pals.view(numpy.uint32)[:, None, :, 0]).argmax(axis = 2)
+    indices = indices.reshape(ng, 16, 4).astype(numpy.uint8)
+    chars = (indices[:, :, 0] << 6) | (indices[:, :, 1] << 4) | (indices[:, :, 2] << 2) | indices[:, :, 3]
+
+    (r, g, b, a) = [pals[:, :, c].astype(numpy.uint16) for c in range(4)]
+    ph = ((a < 128).astype(numpy.uint16) << 15) | ((r >> 3) << 10) | ((g >> 3) << 5) | (b >> 3)
+    return (array('B', chars.tostring()), array('H', ph.tostring()))
 
 def getpal(im):
     """ im is a paletted image.  Return its palette as a Gameduino sprite palette
@@ -191,7 +490,8 @@ def encode(im):
 
     The image must have dimensions that are multiples of 8.
     If any character cell contains more than four colors, then the cell's pixel are quantized to four colors before encoding.
-    If the image requires more than 256 unique character cells, this function throws exception OverflowError.
+    If the image requires more than 256 unique character cells, this function throws exception OverflowError;
+    :func:`encode_lossy` merges similar cells instead.
     The tuple returned contains three pieces of data:
     
     * picture - the bytes representing the character cells.  For input image sized (w, h) this array has size (w/8)*(h/8).  Type of this array is 'B' (unsigned byte)
@@ -224,31 +524,360 @@ def encode(im):
 
     if im.mode != "RGBA":
         im = im.convert("RGBA")
-    charset = {} # dict that maps 8x8 images to byte charcodes
-    picture = [] # 64x64 byte picture RAM
-    for y in range(0, im.size[1], 8):
-        for x in range(0, im.size[0], 8):
-            iglyph = getch(im, x, y)
-            glyph = iglyph.tostring()
-            if not glyph in charset:
-                if len(charset) == 256:
-                    raise OverflowError
-                charset[glyph] = len(charset)
-            picture.append(charset[glyph])
-    picd = array('B', picture)
-    cd = array('B', [0] * 16 * len(charset))
-    pd = array('H', [0] * 4 * len(charset))
-    for d,i in charset.items():
-        for y in range(8):
-            (char, pal) = encodech(d)
-            cd[16 * i:16 * (i+1)] = array('B', char)
-            pd[4 * i:4 * (i+1)] = pal
+    (glyphs, picture) = charcells(im)
+    if len(glyphs) > 256:
+        raise OverflowError
+    picd = array('B', picture.astype(numpy.uint8).tostring())
+    (cd, pd) = encodechars(glyphs)
     return (picd, cd, pd)
 
-def preview(picd, cd, pd):
-    preview = Image.new("RGB", im.size)
-    preview.paste(iglyph, (x, y))
-    return preview
+def encode_lossy(im, maxchars = 256):
+    """
+    Convert a PIL image to a Gameduino character background image, as :func:`encode` does,
+    but instead of failing when the image needs more than ``maxchars`` unique character cells,
+    merge similar cells.
+
+    :param im: A Python Imaging Library image
+    :param maxchars: size of the character set to fit in
+    :rtype: tuple of (picture, character, palette, error)
+
+    The glyphs are clustered into at most ``maxchars`` groups, comparing their 8x8 RGBA pixels,
+    and every cell is drawn with the glyph of its group nearest the group center.
+    Picture, character and palette are as for :func:`encode`; error is the root-mean-square
+    difference between the image and the encoded result, per 8-bit channel.
+    """
+
+    if im.mode != "RGBA":
+        im = im.convert("RGBA")
+    (glyphs, picture) = mergeglyphs(*charcells(im), n = maxchars)
+    drawn = glyphs[picture].view(numpy.uint8).astype(numpy.float64)
+    error = numpy.sqrt(((cells(im).reshape(drawn.shape) - drawn) ** 2).mean())
+    picd = array('B', picture.astype(numpy.uint8).tostring())
+    (cd, pd) = encodechars(glyphs)
+    return (picd, cd, pd, error)
+
+def charcells(im):
+    """
+    Split RGBA image im into 8x8 character cells, quantizing any cell with more than four colors.
+    Return the unique glyphs as a (n, 64) :class:`numpy.ndarray` of 32-bit RGBA pixels, in order of
+    first appearance, and the glyph number of every cell in raster order.
+    """
+    px = cells(im).reshape(-1, 64, 4).view(numpy.uint32)[:, :, 0] # one word per pixel
+
+    # Count the colors in each cell; cells with more than 4 are quantized
+    # together, opaque like the cells getch() returns
+    s = numpy.sort(px, axis = 1)
+    ncolors = 1 + (s[:, 1:] != s[:, :-1]).sum(axis = 1)
+    over = numpy.flatnonzero(ncolors > 4)
+    if len(over):
+        rgba = px[over].view(numpy.uint8).reshape(-1, 64, 4)
+        rgba[:, :, :3] = quantize4(rgba[:, :, :3])
+        rgba[:, :, 3] = 255
+        px[over] = rgba.reshape(-1, 256).view(numpy.uint32)
+
+    # Unique glyphs, numbered in order of first appearance
+    (_, first, inverse) = numpy.unique(px.view(numpy.dtype((numpy.void, 256))),
+                                       return_index = True, return_inverse = True)
+    order = numpy.argsort(first)
+    rank = numpy.empty(len(order), numpy.intp)
+    rank[order] = numpy.arange(len(order))
+    return (px[first[order]], rank[inverse.ravel()])
+
+def nearest(x, centers):
+    """
+    For each row of ``x``, find the nearest row of ``centers``.
+    Returns the index of the nearest center and the squared distance to it.
+    """
+    # |x - c|^2 = |x|^2 - 2x.c + |c|^2, so one matrix product per chunk covers every pair
+    c2 = (centers ** 2).sum(axis = 1)
+    ix = numpy.empty(len(x), numpy.intp)
+    d = numpy.empty(len(x))
+    for i in range(0, len(x), 4096):
+        chunk = x[i:i + 4096]
+        dd = c2[None, :] - 2 * numpy.dot(chunk, centers.T)
+        ix[i:i + 4096] = dd.argmin(axis = 1)
+        d[i:i + 4096] = numpy.maximum(dd[numpy.arange(len(chunk)), ix[i:i + 4096]] + (chunk ** 2).sum(axis = 1), 0)
+    return (ix, d)
+
+def mergeglyphs(glyphs, picture, n = 256):
+    """
+    Merge glyphs, as returned by :func:`charcells`, down to at most ``n`` representatives.
+    Returns the representative glyphs in order of first appearance and the glyph number of every cell.
+    """
+    if len(glyphs) <= n:
+        return (glyphs, picture)
+    x = glyphs.view(numpy.uint8).reshape(len(glyphs), 256).astype(numpy.float64)
+    w = numpy.bincount(picture, minlength = len(glyphs)).astype(numpy.float64)
+
+    # Seed with the most used glyph, then repeatedly the glyph costing most, weighted by use
+    seeds = [w.argmax()]
+    d = ((x - x[seeds[0]]) ** 2).sum(axis = 1)
+    while len(seeds) < n:
+        s = (w * d).argmax()
+        seeds.append(s)
+        d = numpy.minimum(d, ((x - x[s]) ** 2).sum(axis = 1))
+
+    # A few rounds of weighted k-means
+    centers = x[seeds]
+    for i in range(4):
+        (ix, _) = nearest(x, centers)
+        total = numpy.bincount(ix, w, n)
+        for c in range(256):
+            centers[:, c] = numpy.where(total > 0, numpy.bincount(ix, w * x[:, c], n) / numpy.maximum(total, 1), centers[:, c])
+
+    # Each cluster is represented by its member nearest the center, so
+    # every representative is a real glyph of at most four colors
+    (ix, d) = nearest(x, centers)
+    reps = numpy.unique([numpy.flatnonzero(ix == c)[d[ix == c].argmin()] for c in numpy.unique(ix)])
+    (ix, _) = nearest(x, x[reps])
+    return (glyphs[reps], ix[picture])
+
+def rgbacharcells(job):
+    # charcells() for an image sent to a worker process as raw RGBA data
+    (size, data) = job
+    return charcells(Image.fromstring("RGBA", size, data))
+
+def manycharcells(images, workers):
+    # charcells() for every image in images, spread over a pool of worker processes
+    jobs = []
+    for im in images:
+        if im.mode != "RGBA":
+            im = im.convert("RGBA")
+        jobs.append((im.size, im.tostring()))
+    if workers == 1:
+        return map(rgbacharcells, jobs)
+    pool = multiprocessing.Pool(workers)
+    try:
+        return pool.map(rgbacharcells, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+def encode_many(images, workers = None):
+    """
+    Convert a list of PIL images to Gameduino character background images that share one character set.
+
+    :param images: list of Python Imaging Library images
+    :param workers: number of worker processes; default is one per CPU, 1 encodes in this process
+    :rtype: tuple (pictures, character, palette) where pictures is a list of :class:`array.array`, one per image
+
+    Each image is encoded as by :func:`encode`, with the cell work spread over a pool of
+    worker processes.  The glyphs of all images are merged into a single character set of
+    at most 256 characters, numbered in order of first appearance across ``images``, so every
+    picture can be displayed with the same character and palette RAM.
+
+    If the images together need more than 256 unique character cells, this function throws
+    exception OverflowError, naming the first image that did not fit.
+    """
+
+    results = manycharcells(images, workers)
+    charset = {} # dict that maps 8x8 glyphs to byte charcodes
+    glyphs = []
+    pictures = []
+    for (i, (imglyphs, picture)) in enumerate(results):
+        codes = array('B')
+        for glyph in imglyphs:
+            key = glyph.tostring()
+            if not key in charset:
+                if len(charset) == 256:
+                    raise OverflowError("image %d does not fit in the 256-character set" % i)
+                charset[key] = len(charset)
+                glyphs.append(glyph)
+            codes.append(charset[key])
+        pictures.append(array('B', [codes[c] for c in picture]))
+    (cd, pd) = encodechars(numpy.array(glyphs, numpy.uint32).reshape(-1, 64))
+    return (pictures, cd, pd)
+
+PLAY_FRAME = """\
+static prog_uchar *%(name)s_frame(prog_uchar *p)
+{
+  unsigned int n = pgm_read_word_near(p); p += 2;
+  while (n--) {
+    byte slot = pgm_read_byte_near(p++);
+    GD.copy(RAM_CHR + 16 * slot, p, 16); p += 16;
+    GD.copy(RAM_PAL + 8 * slot, p, 8); p += 8;
+  }
+  n = pgm_read_word_near(p); p += 2;
+  while (n--) {
+    unsigned int addr = pgm_read_word_near(p); p += 2;
+    byte len = pgm_read_byte_near(p++);
+    GD.copy(RAM_PIC + addr, p, len); p += len;
+  }
+  return p;
+}
+"""
+
+def encode_frames(hh, name, frames, workers = None):
+    """
+    Encode a sequence of PIL images as an animated Gameduino character background,
+    sending only what changes from frame to frame.
+
+    :param hh: file to write the stream and its playback code to
+    :param name: name of the animation, used for the generated C identifiers
+    :param frames: list of Python Imaging Library images, all the same size, at most 512x512
+    :param workers: number of worker processes for the cell work, as for :func:`encode_many`
+    :rtype: the stream as an :class:`array.array` of type 'B'
+
+    Each frame is split into characters as by :func:`encode`.  The character set persists
+    across frames: a glyph already in character RAM keeps its slot, and a new glyph takes a
+    free slot or the slot of the glyph least recently on screen.  For every frame the stream holds
+
+    * the number of glyph slots to load (2 bytes), then for each: the slot (1 byte), its 16 character bytes and 8 palette bytes
+    * the number of picture RAM runs (2 bytes), then for each: its address in picture RAM (2 bytes), length (1 byte) and bytes
+
+    all little-endian.  The first frame loads everything.  The header file gets the stream ``name_stream``,
+    ``NAME_FRAMES`` and a function ``name_frame()`` that plays one frame and returns where the next begins::
+
+        prog_uchar *p = intro_stream;
+        for (int i = 0; i < INTRO_FRAMES; i++) {
+          GD.waitvblank();
+          p = intro_frame(p);
+        }
+
+    If one frame needs more than 256 unique character cells, this function throws exception OverflowError.
+    """
+
+    sizes = set([im.size for im in frames])
+    assert len(sizes) == 1, "frames differ in size"
+    (w, h) = sizes.pop()
+    assert w % 8 == 0 and h % 8 == 0 and w <= 512 and h <= 512
+    (cols, rows) = (w / 8, h / 8)
+    addr = (64 * numpy.arange(rows)[:, None] + numpy.arange(cols)).ravel()
+
+    slots = {}          # glyph -> slot
+    resident = [None] * 256
+    lastuse = [-1] * 256
+    screen = None
+    stream = array('B')
+    for (f, (glyphs, picture)) in enumerate(manycharcells(frames, workers)):
+        if len(glyphs) > 256:
+            raise OverflowError("frame %d needs more than 256 characters" % f)
+        keys = [g.tostring() for g in glyphs]
+        for k in keys:
+            if k in slots:
+                lastuse[slots[k]] = f
+        loads = []
+        for (k, g) in zip(keys, glyphs):
+            if not k in slots:
+                slot = min(range(256), key = lambda s: lastuse[s])
+                if resident[slot] is not None:
+                    del slots[resident[slot]]
+                resident[slot] = k
+                slots[k] = slot
+                lastuse[slot] = f
+                loads.append((slot, g))
+        codes = numpy.array([slots[k] for k in keys], numpy.uint8)[picture]
+
+        stream.extend(array('B', [len(loads) & 0xff, len(loads) >> 8]))
+        if loads:
+            (cd, pd) = encodechars(numpy.array([g for (_, g) in loads], numpy.uint32))
+            for (i, (slot, _)) in enumerate(loads):
+                stream.append(slot)
+                stream.extend(cd[16 * i:16 * i + 16])
+                stream.fromstring(pd[4 * i:4 * i + 4].tostring())
+
+        # Runs of changed cells within each row; short unchanged gaps are sent
+        # rather than paying for another run header
+        changed = numpy.ones(len(codes), bool) if screen is None else (codes != screen)
+        screen = codes
+        runs = []
+        for y in range(rows):
+            row = numpy.flatnonzero(changed[y * cols:(y + 1) * cols])
+            start = None
+            for x in row:
+                if start is not None and x - end > 4:
+                    runs.append((y * cols + start, end - start + 1))
+                    start = None
+                if start is None:
+                    start = x
+                end = x
+            if start is not None:
+                runs.append((y * cols + start, end - start + 1))
+        stream.extend(array('B', [len(runs) & 0xff, len(runs) >> 8]))
+        for (i, n) in runs:
+            a = addr[i]
+            stream.extend(array('B', [a & 0xff, a >> 8, n]))
+            stream.fromstring(codes[i:i + n].tostring())
+
+    print >>hh, "// %s: %d frames of %dx%d, %d bytes" % (name, len(frames), w, h, len(stream))
+    dump(hh, "%s_stream" % name, stream)
+    print >>hh, "#define %s_FRAMES %d" % (name.upper(), len(frames))
+    hh.write(PLAY_FRAME % {'name': name})
+    return stream
+
+def rgb555torgba(colors):
+    # RGBA pixels for an array of Gameduino colors; bit 15 set means transparent
+    c = numpy.asarray(colors, numpy.uint16).astype(numpy.uint32)
+    five = numpy.stack([(c >> 10) & 31, (c >> 5) & 31, c & 31], axis = -1)
+    rgba = numpy.empty(c.shape + (4,), numpy.uint8)
+    rgba[..., :3] = (five << 3) | (five >> 2)
+    rgba[..., 3] = numpy.where(c & 0x8000, 0, 255)
+    return rgba
+
+def preview(picd, cd, pd, width, background = (0, 0, 0)):
+    """
+    Render encoded background data, as returned by :func:`encode`, the way the Gameduino displays it.
+
+    :param picd: picture data, one character code per cell
+    :param cd: character data, 16 bytes per character
+    :param pd: palette data, 4 colors per character
+    :param width: width of the picture in character cells, not pixels: ``im.size[0] / 8`` for an image ``im`` passed to :func:`encode`, 64 for a whole picture RAM
+    :param background: RGB color shown through transparent pixels
+    :rtype: RGB Python Imaging Library image
+
+    For example, to check that an image survives encoding::
+
+        (picd, cd, pd) = gdprep.encode(im)
+        assert gdprep.preview(picd, cd, pd, im.size[0] / 8).tostring() == expected.tostring()
+    """
+
+    pic = numpy.frombuffer(bytearray(buffer(picd)), numpy.uint8)
+    chars = numpy.frombuffer(bytearray(buffer(cd)), numpy.uint8).reshape(-1, 16)
+    pals = numpy.frombuffer(bytearray(buffer(pd)), numpy.uint16).reshape(-1, 4)
+    assert len(pic) % width == 0, "%d cells do not make rows of %d cells" % (len(pic), width)
+
+    # 2-bit pixel indices, most significant first, then each character's colors
+    ix = (chars[:, :, None] >> numpy.array([6, 4, 2, 0], numpy.uint8)) & 3
+    rgba = rgb555torgba(pals)
+    rgb = numpy.where(rgba[..., 3:] != 0, rgba[..., :3], numpy.array(background, numpy.uint8))
+    glyphs = rgb[numpy.arange(len(pals))[:, None], ix.reshape(-1, 64)].reshape(-1, 8, 8, 3)
+
+    rows = len(pic) / width
+    frame = glyphs[pic.reshape(rows, width)].transpose(0, 2, 1, 3, 4)
+    return Image.fromstring("RGB", (8 * width, 8 * rows), frame.tostring())
+
+def preview_sprites(data, palette, palsel = PALETTE256A[0], columns = 8):
+    """
+    Render sprite image RAM, as returned by :meth:`ImageRAM.used`, through one palette select.
+
+    :param data: sprite image data, 256 bytes per 16x16 sprite image
+    :param palette: the palette's colors, for example from :func:`getpal`
+    :param palsel: the sprite palette select value, 0-15, which picks the bits of each byte used
+    :param columns: number of sprite images in each row of the result
+    :rtype: RGBA Python Imaging Library image, with transparent pixels clear
+
+    For example, to see the images of a four-color sprite set placed in bits 2 and 3::
+
+        gdprep.preview_sprites(ir.used(), gdprep.getpal(im), gdprep.PALETTE4A_BITS23)
+    """
+
+    pixels = numpy.frombuffer(bytearray(buffer(data)), numpy.uint8)
+    if palsel < 4:
+        ix = pixels
+    elif palsel < 8:
+        ix = (pixels >> (4 * ((palsel >> 1) & 1))) & 15
+    else:
+        ix = (pixels >> (2 * ((palsel >> 1) & 3))) & 3
+    lut = numpy.zeros((256, 4), numpy.uint8)
+    colors = rgb555torgba(numpy.frombuffer(bytearray(buffer(array('H', palette))), numpy.uint16))
+    lut[:len(colors)] = colors
+
+    pages = len(ix) / 256
+    rows = (pages + columns - 1) / columns
+    tiles = numpy.zeros((rows * columns, 16, 16, 4), numpy.uint8)
+    tiles[:pages] = lut[ix[:256 * pages]].reshape(-1, 16, 16, 4)
+    frame = tiles.reshape(rows, columns, 16, 16, 4).transpose(0, 2, 1, 3, 4)
+    return Image.fromstring("RGBA", (16 * columns, 16 * rows), frame.tostring())
 
 def glom(sizes):
     """ Returns a master size and a list of crop/paste coordinates """
@@ -262,15 +891,127 @@ def glom(sizes):
     return ((mw,mh), r)
 
 
-def palettize(im, ncol):
+def rgbaof(im):
+    # The image as RGB or RGBA, converting paletted images as palettize() does
+    im.load()
+    if im.mode == 'P':
+        return im.convert("RGBA" if 'transparency' in im.info else "RGB")
+    elif im.mode not in ("RGBA", "RGB"):
+        return im.convert("RGB")
+    return im
+
+def rgb15(im):
+    # For RGB or RGBA image im, return the 15-bit color of every pixel, each
+    # pixel's 8-bit RGB, and a mask of its transparent pixels (or None)
+    nc = len(im.mode)
+    px = numpy.frombuffer(im.tostring(), numpy.uint8).reshape(-1, nc)
+    key = ((px[:, 0].astype(numpy.intp) >> 3) << 10) | ((px[:, 1] >> 3).astype(numpy.intp) << 5) | (px[:, 2] >> 3)
+    clear = (px[:, 3] <= 128) if nc == 4 else None
+    return (key, px[:, :3], clear)
+
+def mediancut(count, sums, n):
+    """
+    Median cut over a color histogram.  ``count`` is the number of pixels in each histogram bin,
+    ``sums`` their total (r, g, b).  Returns a list of at most ``n`` (r, g, b) colors.
+    """
+    bins = numpy.flatnonzero(count)
+    w = count[bins]
+    means = sums[bins] / w[:, None]
+    boxes = [numpy.arange(len(bins))]
+    while len(boxes) < n:
+        # split the most populous box that still holds more than one bin
+        splittable = [i for (i, b) in enumerate(boxes) if len(b) > 1]
+        if not splittable:
+            break
+        i = max(splittable, key = lambda i: (w[boxes[i]].sum(), -i))
+        box = boxes[i]
+        m = means[box]
+        ch = (m.max(axis = 0) - m.min(axis = 0)).argmax()
+        order = box[m[:, ch].argsort(kind = 'mergesort')]
+        cum = w[order].cumsum()
+        cut = min(max(numpy.searchsorted(cum, cum[-1] / 2.0) + 1, 1), len(order) - 1)
+        boxes[i:i + 1] = [order[:cut], order[cut:]]
+    return [tuple(int(c + .5) for c in sums[bins[b]].sum(axis = 0) / w[b].sum()) for b in boxes]
+
+def maprgb15(job):
+    # Map an image, sent to a worker process as raw data, to palette indices by its 15-bit colors
+    (mode, size, data, lut, clear) = job
+    (key, _, mask) = rgb15(Image.fromstring(mode, size, data))
+    ix = lut[key]
+    if mask is not None:
+        ix[mask] = clear
+    return ix.tostring()
+
+def palettize_stream(ims, ncol, workers = 1):
+    # palettize() for a list of images, without pasting them into one master image
+    ims = [rgbaof(i) for i in ims]
+    transparent = any([i.mode == "RGBA" for i in ims])
+    npal = ncol - 1 if transparent else ncol
+
+    # Histogram at the Gameduino's 15-bit color resolution, one image at a time
+    count = numpy.zeros(32768, numpy.int64)
+    sums = numpy.zeros((32768, 3))
+    for i in ims:
+        (key, rgb, clear) = rgb15(i)
+        if clear is not None:
+            key = key[~clear]
+            rgb = rgb[~clear]
+        count += numpy.bincount(key, minlength = 32768)
+        for c in range(3):
+            sums[:, c] += numpy.bincount(key, rgb[:, c], 32768)
+    palette = mediancut(count, sums, npal)
+
+    # Each used bin maps to the palette color nearest its mean color
+    lut = numpy.zeros(32768, numpy.uint8)
+    used = numpy.flatnonzero(count)
+    if palette:
+        means = sums[used] / count[used][:, None]
+        pal = numpy.array(palette, float)
+        for i in range(0, len(used), 4096):
+            d = ((means[i:i + 4096, None, :] - pal[None, :, :]) ** 2).sum(axis = 2)
+            lut[used[i:i + 4096]] = d.argmin(axis = 1)
+
+    # One image's pixels at a time go to the workers, and come back as they finish
+    jobs = ((i.mode, i.size, i.tostring(), lut, ncol - 1) for i in ims)
+    if workers == 1:
+        pool = None
+        indices = itertools.imap(maprgb15, jobs)
+    else:
+        pool = multiprocessing.Pool(workers)
+        indices = pool.imap(maprgb15, jobs)
+
+    flat = sum([list(c) for c in palette], [])
+    flat += [0] * (768 - len(flat))
+    r = []
+    try:
+        for (i, ix) in itertools.izip(ims, indices):
+            p = Image.fromstring('P', i.size, ix)
+            p.putpalette(flat)
+            if transparent:
+                p.info['transparency'] = ncol - 1
+            r.append(p)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return r
+
+def palettize(im, ncol, streaming = False, workers = 1):
     """ Given an input image or list of images, convert to a palettized version using at most ``ncol`` colors.
     This function preserves transparency: if the input(s) have transparency then the returned
     image(s) have ``.info['transparency']`` set to the transparent color.
 
     If ``im`` is a single image, returns a single image.  If ``im`` is a list of images, returns a list of images.
+
+    For a long list of images, set ``streaming``.  Instead of pasting all the images into one tall
+    master image, this builds the shared palette by median cut over a color histogram at the Gameduino's
+    15-bit color resolution, accumulated one image at a time, then maps each image to the palette on its own,
+    using ``workers`` processes.
     """
     
     assert ncol in (4, 16, 256)
+    if isinstance(im, list) and streaming:
+        return palettize_stream(im, ncol, workers)
     if isinstance(im, list):
         # For a list of images, paste them all into a single image,
         # palettize the single image, then return cropped subimages
@@ -302,6 +1043,7 @@ def palettize(im, ncol):
     else:
         alpha = im.split()[3]
         mask = Image.eval(alpha, lambda a: 255 if a <= 128 else 0)
+        im = im.copy()  # leave the caller's image alone
         im.paste((0,0,0), mask)
         im = im.convert('RGB').convert('P', palette=Image.ADAPTIVE, colors = (ncol - 1))
         im.paste(ncol - 1, mask)
@@ -311,13 +1053,135 @@ def palettize(im, ncol):
 def isnonblank(im):
     assert im.mode == 'P'
     if 'transparency' in im.info:
-        transparent = im.info['transparency']
-        (w,h) = im.size
-        colors = set([im.getpixel((i, j)) for i in range(w) for j in range(h)])
-        return colors != set([transparent])
+        data = im.tostring()
+        return data.count(chr(im.info['transparency'])) != len(data)
     else:
         return True
 
+def popcount(bits):
+    return bin(bits).count("1")
+
+def sharepalettes(sets, hh = None, name = "sprites"):
+    """
+    Choose a palette and bit depth for each of several sprite sets, sharing palettes between
+    sets where their colors allow, so that the sets take as little sprite image RAM as possible.
+
+    :param sets: list of (name, image) for each sprite set; images may be RGB, RGBA or paletted
+    :param hh: if given, header file to write the palettes to, as ``name_palette4a``, ``name_palette16b``...
+    :param name: prefix for the palette names in the header file
+    :rtype: tuple (choices, palettes).  ``choices`` maps each sprite set name to (palset, image), where
+        image is the set converted to a paletted image in its palette, ready for :meth:`ImageRAM.addsprites`.
+        ``palettes`` maps each palette used, "4A", "16A", "256A"... to its colors, as from :func:`getpal`.
+
+    Colors are compared as the Gameduino shows them, at 15 bits, and a transparent pixel (alpha 128 or less)
+    takes one palette entry.  Sets are placed largest first, each in the smallest bit depth that works:
+    a four-color palette if one can take its colors, then a sixteen-color palette, then a 256-color palette.
+    Within a depth, a set goes to the palette that needs fewest new colors.  A set with more than 256
+    colors is first reduced with :func:`palettize`.  If a set fits in no palette, this function
+    throws exception OverflowError.
+
+    For example::
+
+        (choices, palettes) = gdprep.sharepalettes([("ship", ship), ("rock", rock)], hh)
+        for (n, im) in [("ship", ship), ("rock", rock)]:
+            (palset, pim) = choices[n]
+            ir.addsprites(n, (16, 16), pim, palset)
+    """
+
+    TRANSPARENT = 1 << 15
+    slots = [(4, "4A", PALETTE4A), (4, "4B", PALETTE4B),
+             (16, "16A", PALETTE16A), (16, "16B", PALETTE16B),
+             (256, "256A", PALETTE256A), (256, "256B", PALETTE256B),
+             (256, "256C", PALETTE256C), (256, "256D", PALETTE256D)]
+
+    # Each set's colors as a bitset over the distinct colors of all the sets
+    bit = {}
+    info = []
+    for (n, im) in sets:
+        im = rgbaof(im)
+        (key, _, clear) = rgb15(im)
+        if len(numpy.unique(key if clear is None else key[~clear])) > 256:
+            im = rgbaof(palettize(im, 256))
+            (key, _, clear) = rgb15(im)
+        used = key if clear is None else numpy.where(clear, TRANSPARENT, key)
+        colors = 0
+        for c in numpy.unique(used).tolist():
+            colors |= 1 << bit.setdefault(c, len(bit))
+        # 16x16 pieces holding any visible pixel, as addsprites() stores them
+        (w, h) = im.size
+        visible = numpy.ones(len(key), bool) if clear is None else ~clear
+        occupied = numpy.zeros(((h + 15) / 16, (w + 15) / 16), bool)
+        (ys, xs) = numpy.nonzero(visible.reshape(h, w))
+        occupied[ys / 16, xs / 16] = True
+        info.append((n, im, key, clear, colors, occupied.sum()))
+
+    contents = [0] * len(slots)
+    place = {}
+    for (n, im, key, clear, colors, pieces) in sorted(info, key = lambda t: (-t[5], -popcount(t[4]))):
+        for depth in (4, 16, 256):
+            fits = [(popcount(contents[i] | colors), i) for (i, (d, _, _)) in enumerate(slots)
+                    if d == depth and popcount(contents[i] | colors) <= depth]
+            if fits:
+                i = min(fits)[1]
+                contents[i] |= colors
+                place[n] = i
+                break
+        else:
+            raise OverflowError("sprite set %s does not fit in any palette" % n)
+
+    # Palettes: each slot's colors in order, transparent last
+    byvalue = dict([(b, c) for (c, b) in bit.items()])
+    palettes = {}
+    luts = {}
+    for (i, (depth, slotname, _)) in enumerate(slots):
+        if not i in place.values():
+            continue
+        members = [byvalue[b] for b in range(len(bit)) if contents[i] >> b & 1]
+        pal = array('H', [0] * depth)
+        lut = numpy.zeros(32768, numpy.uint8)
+        opaque = [c for c in members if c != TRANSPARENT]
+        for (j, c) in enumerate(opaque):
+            pal[j] = c
+            lut[c] = j
+        if TRANSPARENT in members:
+            pal[depth - 1] = 0x8000
+        palettes[slotname] = pal
+        luts[i] = lut
+
+    choices = {}
+    for (n, im, key, clear, colors, pieces) in info:
+        (depth, slotname, palset) = slots[place[n]]
+        ix = luts[place[n]][key]
+        if clear is not None:
+            ix[clear] = depth - 1
+        pim = Image.fromstring('P', im.size, ix.tostring())
+        rgb = rgb555torgba(palettes[slotname])[:, :3]
+        pim.putpalette(rgb.tostring() + chr(0) * (768 - 3 * depth))
+        if clear is not None and clear.any():
+            pim.info['transparency'] = depth - 1
+        choices[n] = (palset, pim)
+        if hh is not None:
+            print >>hh, "// sprite set %s: palette %s" % (n, slotname)
+    if hh is not None:
+        for (depth, slotname, _) in slots:
+            if slotname in palettes:
+                dump(hh, "%s_palette%s" % (name, slotname.lower()), palettes[slotname])
+    return (choices, palettes)
+
+DRAW_PIECES = """#ifndef DRAW_PIECES
+#define DRAW_PIECES
+static void draw_pieces(const prog_uchar *pieces, const prog_uint16_t *frames, int x, int y, int anim, byte rot, byte jk) {
+  uint16_t end = pgm_read_word_near(frames + anim + 1);
+  for (uint16_t i = pgm_read_word_near(frames + anim); i < end; i++) {
+    const prog_uchar *p = pieces + 4 * i;
+    GD.xsprite(x, y, (signed char)pgm_read_byte_near(p), (signed char)pgm_read_byte_near(p + 1),
+               pgm_read_byte_near(p + 2), pgm_read_byte_near(p + 3), rot, jk);
+  }
+}
+#endif
+
+"""
+
 class ImageRAM(object):
     """
 
@@ -325,18 +1189,48 @@ class ImageRAM(object):
     A caller adds sprite images to the ImageRAM, and finally obtains a memory image
     using :meth:`ImageRAM.used`.
 
+    Images are placed best-fit: each goes into the fullest page that still has
+    room for it, so 4-, 16- and 256-color images share pages without leaving holes.
+    With ``offline`` set, :meth:`ImageRAM.addsprites` only collects its sprite sets;
+    :meth:`ImageRAM.pack` then places all of their images, largest first, to use
+    the fewest pages, and writes their drawing code.
+
+    With ``tables`` set, the drawing code for each sprite set is a table of
+    pieces (x and y offset, image, palette select) and a table of where each frame's pieces
+    start, both walked by one shared ``draw_pieces()`` function.  This is much smaller than a ``switch``
+    statement for sheets with many frames.
+
     """
-    def __init__(self, hh):
+    def __init__(self, hh, offline = False, tables = False):
         self.hh = hh
-        self.data = array('B', [0] * 16384)
-        self.nxtpage = 0    # next available page
-        self.nxtbit = 0     # next available bit
-
-    def __bump(self, b):
-        self.nxtbit += b
-        if 8 == self.nxtbit:
-            self.nxtbit = 0
-            self.nxtpage += 1
+        self.data = numpy.zeros(16384, numpy.uint8)
+        self.vacant = [0xff] * 64   # free bit-planes of each page
+        self.tiles = {}     # maps (data, size) to (image, pal) of tiles already added
+        self.offline = offline
+        self.pending = []   # sprite sets waiting for pack()
+        self.tables = tables
+        self.drawloop = False   # draw_pieces() written yet?
+
+    def __alloc(self, bits):
+        # Best fit: the fullest page with a free aligned slot, and in that page
+        # a slot whose neighbor is taken, so that wider slots stay whole
+        mask = (1 << bits) - 1
+        best = None
+        for pg in range(64):
+            vacant = self.vacant[pg]
+            for b in range(0, 8, bits):
+                if (vacant >> b) & mask == mask:
+                    split = bits < 8 and ((vacant >> (b ^ bits)) & mask) == mask
+                    fit = (bin(vacant).count("1"), split, pg, b)
+                    if best is None or fit < best:
+                        best = fit
+            if vacant == 0xff and best is not None:
+                break   # any later empty page would be no better
+        if best is None:
+            raise OverflowError
+        (_, _, pg, b) = best
+        self.vacant[pg] &= ~(mask << b)
+        return (pg, b)
 
     def add(self, page, size):
         """
@@ -353,29 +1247,44 @@ class ImageRAM(object):
 
         The ``image`` and ``pal`` values may be used to display the sprite using :cpp:func:`GD::sprite`.
 
+        If the same data has already been added with the same ``size``, this method returns its
+        existing location and uses no more space.
+
         If the data would cause the ImageRAM to increase beyond 16K, this method throws exception OverflowError.
         """
+        tile = numpy.asarray(page)
         assert size in (4,16,256)
-        assert max(page) < size, "%d colors allowed, but page contains %d" % (size, max(page))
-        assert len(page) == 256
+        assert tile.max() < size, "%d colors allowed, but page contains %d" % (size, tile.max())
+        assert len(tile) == 256
 
+        tile = tile.astype(numpy.uint8)
+        key = (tile.tostring(), size)
+        if key in self.tiles:
+            return self.tiles[key]
         bits = {4:2, 16:4, 256:8}[size]
-        while (self.nxtbit % bits) != 0:
-            self.__bump(2)
-        if self.nxtpage == 64:
-            raise OverflowError
-        if size == 4:
-            pal = self.nxtbit / 2
-        elif size == 16:
-            pal = self.nxtbit / 4
-        else:
-            pal = 0
-        pg = self.nxtpage
-        for i in range(256):
-            self.data[256 * self.nxtpage + i] |= (page[i] << self.nxtbit)
-        self.__bump(bits)
+        (pg, b) = self.__alloc(bits)
+        pal = b / bits
+        self.data[256 * pg:256 * (pg + 1)] |= tile << b
+        self.tiles[key] = (pg, pal)
         return (pg, pal)
 
+    def remove(self, image, pal, size):
+        """
+        Remove a sprite image from the ImageRAM, freeing its bit-planes for later images.
+
+        :param image: sprite image 0-63, as returned by :meth:`ImageRAM.add`
+        :param pal: palette bit select, as returned by :meth:`ImageRAM.add`
+        :param size: size of data elements, either 4, 16 or 256
+        """
+        bits = {4:2, 16:4, 256:8}[size]
+        mask = ((1 << bits) - 1) << (pal * bits)
+        assert (self.vacant[image] & mask) == 0, "image %d pal %d is not in use" % (image, pal)
+        self.vacant[image] |= mask
+        self.data[256 * image:256 * (image + 1)] &= 0xff ^ mask
+        for (k, loc) in self.tiles.items():
+            if loc == (image, pal) and k[1] == size:
+                del self.tiles[k]
+
     def addsprites(self, name, size, im, palset = PALETTE256A, center = (0,0)):
         """
         Extract multiple sprite frames from a source image, and generate the code to draw them.
@@ -405,6 +1314,9 @@ class ImageRAM(object):
             ...
             }
 
+        In offline mode the sprite set is only recorded; its images are placed
+        and its code is written by :meth:`ImageRAM.pack`.
+
         For more more examples, see the :ref:`asteroids` demo game.
         """
 
@@ -417,9 +1329,6 @@ class ImageRAM(object):
                     yield im.crop((x, y, x + size[0], y + size[1]))
         tiles = list(walktile(im, size))
 
-        print >>self.hh, "#define %s_FRAMES %d" % (name.upper(), len(tiles))
-        animtype = ["byte", "int"][len(tiles) > 255]
-        print >>self.hh, """static void draw_%s(int x, int y, %s anim, byte rot, byte jk = 0) {\n  switch (anim) {""" % (name, animtype)
         if palset == PALETTE256A:
             ncolors = 256
         elif palset == PALETTE256B:
@@ -439,35 +1348,442 @@ class ImageRAM(object):
         else:
             highest = ord(max(im.tostring()))
             ncolors = min([c for c in [4,16,256] if (highest < c)])
+        frames = []     # for each frame, the (x, y, data) of its non-blank 16x16 pieces
         for spr,spriteimage in enumerate(tiles):
-            loads = []
+            pieces = []
             for y in range((size[1] + 15) / 16):
                 for x in range((size[0] + 15) / 16):
                     t = get16x16(spriteimage, x, y)
                     t.info = im.info    # workaround: PIL does not copy .info when cropping
                     if isnonblank(t):
-                        (page, palsel) = self.add(array('B', t.tostring()), ncolors)
-                        loads += ["    GD.xsprite(x, y, %d, %d, %d, %d, rot, jk);" % (x * 16 - center[0], y * 16 - center[1], page, palset[palsel])]
-            if loads:
-                print >>self.hh, "  case %d:" % spr
-                print >>self.hh, "\n".join(loads)
-                print >>self.hh, "    break;"
+                        pieces.append((x * 16 - center[0], y * 16 - center[1], t.tostring()))
+            frames.append(pieces)
+
+        if self.offline:
+            self.pending.append((name, frames, ncolors, palset))
+        else:
+            self.__draw(name, frames, ncolors, palset)
+
+    def __draw(self, name, frames, ncolors, palset):
+        # Add the pieces of every frame, and write the code to draw them
+        located = []
+        for pieces in frames:
+            loads = []
+            for (x, y, data) in pieces:
+                (page, palsel) = self.add(numpy.frombuffer(data, numpy.uint8), ncolors)
+                loads.append((x, y, page, palset[palsel]))
+            located.append(loads)
+
+        text = ["#define %s_FRAMES %d\n" % (name.upper(), len(frames))]
+        animtype = ["byte", "int"][len(frames) > 255]
+        if not self.tables:
+            text.append("""static void draw_%s(int x, int y, %s anim, byte rot, byte jk = 0) {\n  switch (anim) {\n""" % (name, animtype))
+            for spr,loads in enumerate(located):
+                if loads:
+                    text.append("  case %d:\n" % spr)
+                    text.extend(["    GD.xsprite(x, y, %d, %d, %d, %d, rot, jk);\n" % l for l in loads])
+                    text.append("    break;\n")
+            text.append("""  }\n}\n\n""")
+        else:
+            if not self.drawloop:
+                text.insert(0, DRAW_PIECES)
+                self.drawloop = True
+            pieces = []
+            starts = [0]
+            for loads in located:
+                for (x, y, page, pal) in loads:
+                    assert -128 <= x < 128 and -128 <= y < 128, "sprite %s: offset (%d, %d) does not fit in a signed byte" % (name, x, y)
+                    pieces.extend([x & 0xff, y & 0xff, page, pal])
+                starts.append(len(pieces) / 4)
+            text.append("static PROGMEM prog_uchar %s_pieces[] = {\n" % name)
+            pieces = pieces or [0]     # C does not allow an empty table
+            text.extend([" ".join([hexbytes[c] for c in pieces[i:i+16]]) + "\n" for i in range(0, len(pieces), 16)])
+            text.append("};\n")
+            text.append("static PROGMEM prog_uint16_t %s_frames[] = {\n" % name)
+            text.extend([" ".join(["%d," % c for c in starts[i:i+16]]) + "\n" for i in range(0, len(starts), 16)])
+            text.append("};\n")
+            text.append("""static void draw_%s(int x, int y, %s anim, byte rot, byte jk = 0) {\n  draw_pieces(%s_pieces, %s_frames, x, y, anim, rot, jk);\n}\n\n""" % (name, animtype, name, name))
+        self.hh.write("".join(text))
+
+    def pack(self):
+        """
+        Place the images of all sprite sets recorded in offline mode, and write their drawing code.
 
-        print >>self.hh, """  }\n}\n"""
+        Images are added 256-color first, then 16-color, then 4-color, which packs them into
+        the fewest pages.  The drawing code is written in the order of the :meth:`ImageRAM.addsprites` calls.
+        :meth:`ImageRAM.used` calls this method, so it need only be called to get the code written earlier.
+        """
+        pending = self.pending
+        self.pending = []
+        order = []
+        seen = set()
+        for (name, frames, ncolors, palset) in pending:
+            for pieces in frames:
+                for (x, y, data) in pieces:
+                    if not (data, ncolors) in seen:
+                        seen.add((data, ncolors))
+                        order.append((data, ncolors))
+        order.sort(key = lambda t: -t[1])
+        for (data, ncolors) in order:
+            self.add(numpy.frombuffer(data, numpy.uint8), ncolors)
+        for (name, frames, ncolors, palset) in pending:
+            self.__draw(name, frames, ncolors, palset)
 
     def used(self):
         """
-        Return the contents of the ImageRAM, as an :class:`array.array` of type 'B'.
+        Return the contents of the ImageRAM, as a :class:`numpy.ndarray` of type uint8.
         The size of the array depends on the amount of data added, up to a limit
-        of 16K.
+        of 16K.  The array is a view of the ImageRAM's memory, not a copy.
+        """
+        self.pack()
+        past = 0
+        for pg in range(64):
+            if self.vacant[pg] != 0xff:
+                past = pg + 1
+        return self.data[:256*past]
+
+class BankedImageRAM(object):
+    """
+
+    A BankedImageRAM spreads sprite sets over several 16K sprite image RAM banks,
+    for games whose sprites do not all fit at once.  The caller adds sprite sets
+    with :meth:`BankedImageRAM.addsprites` and says which sets each game scene
+    needs with :meth:`BankedImageRAM.scene`.  :meth:`BankedImageRAM.pack` then
+    gives every sprite set one fixed location, shared only with sets that never
+    appear in the same scene, and writes to the header file:
+
+    * the drawing code for every sprite set, as :meth:`ImageRAM.addsprites` does, table-driven if ``tables`` is set
+    * one memory image per distinct scene content, ``name_bank0``, ``name_bank1``...
+    * for each scene change, the list of pages that must be uploaded, ``name_swap_from_to``,
+      or ``name_load_to`` when entering a scene with nothing useful in sprite RAM
+
+    For example::
+
+        import gameduino.prep as gdprep
+        br = gdprep.BankedImageRAM(open("hdr.h", "w"), "sprites")
+        br.addsprites("ship", (16, 16), ship, gdprep.PALETTE16A)
+        br.addsprites("rock", (32, 32), rock, gdprep.PALETTE256A)
+        br.addsprites("boss", (64, 64), boss, gdprep.PALETTE256B)
+        br.scene("asteroids", ["ship", "rock"])
+        br.scene("bossfight", ["ship", "boss"])
+        br.pack()
+
+    and the sketch changes scene by copying only the listed pages::
+
+        for (byte i = 0; i < SPRITES_SWAP_ASTEROIDS_BOSSFIGHT_PAGES; i++) {
+          byte page = pgm_read_byte_near(sprites_swap_asteroids_bossfight + i);
+          GD.copy(RAM_SPRIMG + 256 * page, sprites_bank1 + 256 * page, 256);
+        }
+
+    """
+    def __init__(self, hh, name = "sprites", tables = False):
+        self.hh = hh
+        self.name = name
+        self.tables = tables
+        self.sets = []      # (name, size, im, palset, center) for each sprite set
+        self.scenes = []    # (name, names of the sprite sets it needs)
+
+    def addsprites(self, name, size, im, palset = PALETTE256A, center = (0,0)):
         """
-        if self.nxtbit == 0:
-            past = self.nxtpage
+        Add a sprite set.  The arguments are as for :meth:`ImageRAM.addsprites`.
+        """
+        self.sets.append((name, size, im, palset, center))
+
+    def scene(self, name, sets):
+        """
+        Declare a game scene.
+
+        :param name: name of the scene
+        :param sets: names of the sprite sets that must be in sprite RAM during the scene
+
+        Every name must be that of a sprite set added with :meth:`BankedImageRAM.addsprites`,
+        before or after this call; :meth:`BankedImageRAM.pack` throws exception KeyError otherwise.
+        Scene names go into C identifiers such as ``name_swap_from_to``, where "_" would make
+        them ambiguous, so a name containing "_" throws exception ValueError.
+        """
+        if "_" in name:
+            raise ValueError("scene name %s contains _" % name)
+        self.scenes.append((name, list(sets)))
+
+    def pack(self, transitions = None):
+        """
+        Place all sprite sets and write the header file.
+
+        :param transitions: list of (from, to) scene name pairs needing a swap list.
+            ``from`` may be None, meaning sprite RAM holds nothing useful yet.
+            Default is entering the first scene, then each scene to the next in the order declared.
+        :rtype: dict mapping each transition to its list of pages to upload
+
+        If a scene names a sprite set that was never added, this method throws exception KeyError.
+        If the sprite sets of one scene do not fit in 16K, this method throws exception OverflowError.
+        """
+        setnames = set([n for (n, _, _, _, _) in self.sets])
+        for (n, needs) in self.scenes:
+            unknown = [s for s in needs if not s in setnames]
+            if unknown:
+                raise KeyError("scene %s uses unknown sprite set %s" % (n, ", ".join(unknown)))
+        scenenames = [n for (n, _) in self.scenes]
+        rams = dict([(n, ImageRAM(StringIO.StringIO())) for n in scenenames])
+        users = {}
+        for (n, needs) in self.scenes:
+            for s in needs:
+                users.setdefault(s, []).append(n)
+
+        # Place the sets shared by most scenes first, so they settle in the same pages everywhere
+        code = {}
+        for (name, size, im, palset, center) in sorted(self.sets, key = lambda t: -len(users.get(t[0], []))):
+            where = users.get(name, [])
+            assert where, "sprite set %s is not used in any scene" % name
+            ir = ImageRAM(StringIO.StringIO(), tables = self.tables)
+            ir.drawloop = True
+            ir.vacant = [reduce(lambda a, b: a & b, [rams[n].vacant[pg] for n in where]) for pg in range(64)]
+            before = list(ir.vacant)
+            try:
+                ir.addsprites(name, size, im, palset, center)
+            except OverflowError:
+                raise OverflowError("sprite set %s does not fit in scene %s" % (name, ", ".join(where)))
+            for n in where:
+                ram = rams[n]
+                ram.data |= ir.data
+                ram.vacant = [v & ~(b & ~a) for (v, b, a) in zip(ram.vacant, before, ir.vacant)]
+            code[name] = ir.hh.getvalue()
+        if self.tables:
+            self.hh.write(DRAW_PIECES)
+        for (name, _, _, _, _) in self.sets:
+            self.hh.write(code[name])
+
+        # One bank per distinct scene content
+        banks = []
+        bankof = {}
+        for n in scenenames:
+            img = rams[n].used().tostring()
+            if not img in banks:
+                banks.append(img)
+            bankof[n] = banks.index(img)
+        for (i, img) in enumerate(banks):
+            contents = [s for (s, _, _, _, _) in self.sets if any(bankof[n] == i for n in users[s])]
+            print >>self.hh, "// %s bank %d: scenes %s; sprite sets %s" % (
+                self.name, i, " ".join([n for n in scenenames if bankof[n] == i]), " ".join(contents))
+            dump(self.hh, "%s_bank%d" % (self.name, i), array('B', img))
+        for n in scenenames:
+            print >>self.hh, "#define %s_%s_BANK %d" % (self.name.upper(), n.upper(), bankof[n])
+
+        if transitions is None:
+            transitions = zip([None] + scenenames[:-1], scenenames)
+        plan = {}
+        for (a, b) in transitions:
+            new = rams[b]
+            pages = [pg for pg in range(64) if new.vacant[pg] != 0xff]
+            if a is not None:
+                old = rams[a].data.reshape(64, 256)
+                pages = [pg for pg in pages if (old[pg] != new.data.reshape(64, 256)[pg]).any()]
+            plan[(a, b)] = pages
+            if a is None:
+                label = "load_%s" % b
+            else:
+                label = "swap_%s_%s" % (a, b)
+            print >>self.hh, "static PROGMEM prog_uchar %s_%s[] = { %s };" % (self.name, label, ", ".join(["%d" % pg for pg in pages] or ["0"]))
+            print >>self.hh, "#define %s_%s_PAGES %d" % (self.name.upper(), label.upper(), len(pages))
+        return plan
+
+def freeze(v):
+    # Reduce a result to plain picklable values; arrays and images become strings
+    if isinstance(v, array):
+        return ('array', v.typecode, v.tostring())
+    elif isinstance(v, Image.Image):
+        pal = v.getpalette() if v.mode == 'P' else None
+        return ('image', v.mode, v.size, v.tostring(), pal, dict(v.info))
+    elif isinstance(v, (list, tuple)):
+        return (type(v).__name__, [freeze(x) for x in v])
+    elif isinstance(v, dict):
+        return ('dict', [(k, freeze(x)) for (k, x) in v.items()])
+    else:
+        return ('value', v)
+
+def thaw(v):
+    kind = v[0]
+    if kind == 'array':
+        return array(v[1], v[2])
+    elif kind == 'image':
+        (mode, size, data, pal, info) = v[1:]
+        im = Image.fromstring(mode, size, data)
+        if pal is not None:
+            im.putpalette(pal)
+        im.info = info
+        return im
+    elif kind == 'list':
+        return [thaw(x) for x in v[1]]
+    elif kind == 'tuple':
+        return tuple([thaw(x) for x in v[1]])
+    elif kind == 'dict':
+        return dict([(k, thaw(x)) for (k, x) in v[1]])
+    else:
+        return v[1]
+
+def sourcedigest():
+    # Hash of this module's source, so a cache never outlives a change to the code that filled it
+    fn = os.path.splitext(__file__)[0] + ".py"
+    if not os.path.exists(fn):
+        fn = __file__
+    f = open(fn, "rb")
+    try:
+        return hashlib.sha1(f.read()).hexdigest()
+    finally:
+        f.close()
+
+SOURCE = sourcedigest()
+
+def digest(*parts):
+    """ Return a hex digest identifying the content of ``parts``: images by their pixels, palette and info """
+    h = hashlib.sha1()
+    def feed(v):
+        if isinstance(v, array):
+            h.update('a%s%d:' % (v.typecode, len(v)))
+            h.update(v.tostring())
+        elif isinstance(v, numpy.ndarray):
+            h.update('n%s%r:' % (v.dtype.str, v.shape))
+            h.update(numpy.ascontiguousarray(v).tostring())
+        elif isinstance(v, Image.Image):
+            h.update('i%s%r%r%r:' % (v.mode, v.size, v.getpalette() if v.mode == 'P' else None, sorted(v.info.items())))
+            h.update(v.tostring())
+        elif isinstance(v, (list, tuple)):
+            h.update('l%d:' % len(v))
+            for x in v:
+                feed(x)
+        elif isinstance(v, dict):
+            h.update('d%d:' % len(v))
+            for k in sorted(v):
+                feed(k)
+                feed(v[k])
         else:
-            past = self.nxtpage + 1
-        return array('B', self.data[:256*past])
+            h.update('v%r:' % (v,))
+    feed((SOURCE,) + parts)
+    return h.hexdigest()
+
+class Cache(object):
+    """
+
+    A Cache object keeps the results of :func:`encode`, :func:`palettize`, :func:`getpal`
+    and :meth:`ImageRAM.addsprites` in a directory, so that a rebuild only
+    prepares the images that changed.  Each entry is keyed on the source pixels, the
+    function, its parameters and the source code of this module, so a new version of prep
+    never serves old results.  When the directory grows past ``maxsize`` bytes, the least
+    recently used entries are removed::
+
+        import gameduino.prep as gdprep
+        cache = gdprep.Cache(".gdcache")
+        (dpic, dchr, dpal) = cache.encode(Image.open("titlescreen.png"))
+        ir = gdprep.ImageRAM(open("hdr.h", "w"))
+        cache.addsprites(ir, "rock0", (16, 16), rock0, gdprep.PALETTE16A, center = (8,8))
 
-import math
+    """
+    def __init__(self, path, maxsize = 64 << 20):
+        self.path = path
+        self.maxsize = maxsize
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def get(self, key):
+        """ Return the value stored under ``key``, or None if there is none or it is unreadable """
+        fn = os.path.join(self.path, key)
+        try:
+            f = open(fn, "rb")
+        except IOError:
+            return None
+        try:
+            v = thaw(cPickle.loads(zlib.decompress(f.read())))
+        except (zlib.error, cPickle.UnpicklingError, EOFError):
+            return None         # corrupt entry: a miss, overwritten by the next put()
+        finally:
+            f.close()
+        os.utime(fn, None)      # mark as recently used
+        return v
+
+    def put(self, key, value):
+        """ Store ``value`` under ``key``, then evict old entries if the cache is too big """
+        fn = os.path.join(self.path, key)
+        f = open(fn + ".tmp", "wb")
+        f.write(zlib.compress(cPickle.dumps(freeze(value), 2)))
+        f.close()
+        os.rename(fn + ".tmp", fn)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for n in os.listdir(self.path):
+            st = os.stat(os.path.join(self.path, n))
+            entries.append((st.st_mtime, n, st.st_size))
+        total = sum([sz for (_, _, sz) in entries])
+        for (_, n, sz) in sorted(entries):
+            if total <= self.maxsize:
+                break
+            os.remove(os.path.join(self.path, n))
+            total -= sz
+
+    def call(self, fn, *args):
+        """ Return ``fn(*args)``, from the cache if possible """
+        key = digest(fn.__name__, args)
+        r = self.get(key)
+        if r is None:
+            r = fn(*args)
+            self.put(key, r)
+        return r
+
+    def encode(self, im):
+        """ Cached :func:`encode` """
+        return self.call(encode, im)
+
+    def palettize(self, im, ncol):
+        """ Cached :func:`palettize` """
+        return self.call(palettize, im, ncol)
+
+    def getpal(self, im):
+        """ Cached :func:`getpal` """
+        return self.call(getpal, im)
+
+    def addsprites(self, ir, name, size, im, palset = PALETTE256A, center = (0,0)):
+        """
+        Cached :meth:`ImageRAM.addsprites` for ImageRAM ``ir``.
+        The entry holds the state of ``ir`` after the call and the code written to its header file.
+        """
+        def state():
+            return dict([(k, v) for (k, v) in ir.__dict__.items() if k != 'hh'])
+        key = digest('addsprites', state(), name, size, im, palset, center)
+        r = self.get(key)
+        if r is None:
+            hh = ir.hh
+            ir.hh = StringIO.StringIO()
+            try:
+                ir.addsprites(name, size, im, palset, center)
+                r = (state(), ir.hh.getvalue())
+            finally:
+                ir.hh = hh
+            self.put(key, r)
+        ir.__dict__.update(r[0])
+        ir.hh.write(r[1])
+
+def loudest(freq, db, cutoff, volume, peaks = False):
+    # The cutoff loudest (frequency, amplitude) pairs from 40 to 8192 Hz, loudest first, as spectrum() returns them.
+    # With peaks, only local maxima count, so the skirt of one strong line does not fill the list; a point
+    # must be louder than its left neighbor and at least as loud as its right one, so a flat floor gives none.
+    keep = (40 < freq) & (freq < 8192)
+    if peaks:
+        edge = numpy.array([-numpy.inf])
+        padded = numpy.concatenate([edge, db, edge])
+        keep &= (db > padded[:-2]) & (db >= padded[2:])
+    (freq, db) = (freq[keep], db[keep])
+    if cutoff < len(db):
+        # Partial sort: everything louder than the cutoff-th level, then the
+        # first of those at exactly that level, as a stable sort would pick
+        kth = numpy.partition(db, len(db) - cutoff)[len(db) - cutoff]
+        louder = numpy.flatnonzero(db > kth)
+        top = numpy.concatenate([louder, numpy.flatnonzero(db == kth)[:cutoff - len(louder)]])
+    else:
+        top = numpy.arange(len(db))
+    top = top[numpy.lexsort((top, -db[top]))]
+    amps = numpy.power(2., .1 * db[top]).tolist()
+    samps = sum(amps)
+    return [(f, int(volume * a / samps)) for (f, a) in zip(freq[top].tolist(), amps)]
 
 def spectrum(specfile, cutoff = 64, volume = 255):
     """
@@ -487,12 +1803,231 @@ def spectrum(specfile, cutoff = 64, volume = 255):
 
     """
 
-    snd = [[float(t) for t in l.split()] for l in open(specfile) if not "Freq" in l]
-    snd = [(f,db) for (f,db) in snd if 40 < f < 8192]
-    snd = sorted(snd, reverse=True, key=lambda t:t[1])
-    top = snd[:cutoff]
-    amps = [(f,math.pow(2, .1 * db)) for (f, db) in top]
-    samps = sum([a for (f,a) in amps])
-    return [(f, int(volume * a / samps)) for (f, a) in amps]
+    text = "".join([l for l in open(specfile) if not "Freq" in l])
+    snd = numpy.array(text.split(), float).reshape(-1, 2)
+    return loudest(snd[:, 0], snd[:, 1], cutoff, volume)
+
+def readwav(wavfile):
+    # The samples of a WAV file, channels mixed to mono, as floats; and the sample rate
+    w = wave.open(wavfile, "rb")
+    try:
+        (channels, width, rate, n) = w.getparams()[:4]
+        raw = w.readframes(n)
+    finally:
+        w.close()
+    return (pcm(raw, width, channels), rate)
+
+def pcm(raw, width, channels):
+    # PCM sample data of the given width and number of channels, mixed to mono
+    raw = numpy.frombuffer(raw, numpy.uint8)
+    if width == 1:
+        x = raw.astype(numpy.float64) - 128
+    elif width == 3:
+        b = raw.reshape(-1, 3).astype(numpy.int32)
+        x = ((b[:, 0] << 8) | (b[:, 1] << 16) | (b[:, 2] << 24)) >> 8
+    else:
+        x = raw.view({2: "<i2", 4: "<i4"}[width])
+    return x.reshape(-1, channels).mean(axis = 1)
+
+def wavspectrum(wavfile, cutoff = 64, volume = 255, size = 8192):
+    """
+    Analyze a WAV file and return a list of (frequency, amplitude) pairs for its loudest spectral peaks,
+    loudest first, in the form :func:`spectrum` returns for an Audacity spectrum file.
+    Unlike :func:`spectrum`, only local maxima of the spectrum are taken, so the list may be shorter than ``cutoff``.
+
+    :param wavfile: name of a PCM WAV file, 8, 16, 24 or 32 bits per sample, any number of channels
+    :param cutoff: maximum length of the list of returned pairs
+    :param volume: total volume of the returned pairs
+    :param size: FFT size; frequency resolution is the sample rate divided by ``size``
+
+    The spectrum is the average power over Hann-windowed frames of ``size`` samples, overlapping by half,
+    so no export step in Audacity is needed::
+
+        for (i, (f, a)) in enumerate(wavspectrum("choir.wav")):
+            gd.voice(i, 0, int(4 * f), a, a)
+    """
+
+    (x, rate) = readwav(wavfile)
+    if len(x) < size:
+        x = numpy.concatenate([x, numpy.zeros(size - len(x))])
+    hop = size / 2
+    starts = numpy.arange(0, len(x) - size + 1, hop)
+    window = numpy.hanning(size)
+    power = numpy.zeros(size / 2 + 1)
+    for i in range(0, len(starts), 64):
+        frames = x[starts[i:i + 64, None] + numpy.arange(size)] * window
+        power += (numpy.abs(numpy.fft.rfft(frames, axis = 1)) ** 2).sum(axis = 0)
+    db = 10 * numpy.log10(numpy.maximum(power / len(starts), 1e-20))
+    freq = numpy.arange(len(power)) * float(rate) / size
+    return loudest(freq, db, cutoff, volume, peaks = True)
+
+def filespectrum(job):
+    # wavspectrum() or spectrum(), by file extension, for a worker process
+    (path, cutoff, volume) = job
+    if path.lower().endswith(".wav"):
+        return wavspectrum(path, cutoff, volume)
+    return spectrum(path, cutoff, volume)
+
+def spectra(directory, cutoff = 64, volume = 255, workers = None):
+    """
+    Analyze every sample in a directory, in parallel.
+
+    :param directory: directory holding WAV files (``.wav``) and Audacity spectrum files (``.txt``)
+    :param cutoff: maximum length of each list of returned pairs
+    :param volume: total volume of each list of returned pairs
+    :param workers: number of worker processes; default is one per CPU, 1 works in this process
+    :rtype: dict mapping each file name to its list of (frequency, amplitude) pairs, as :func:`spectrum` returns
+    """
+
+    names = sorted([n for n in os.listdir(directory) if os.path.splitext(n)[1].lower() in (".wav", ".txt")])
+    jobs = [(os.path.join(directory, n), cutoff, volume) for n in names]
+    if workers == 1:
+        results = map(filespectrum, jobs)
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(filespectrum, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    return dict(zip(names, results))
+
+def voiceschedule(wavfile, tickrate = 60, voices = 64, volume = 255, size = 2048,
+                  hold = 1.5, ftol = .005, atol = 2):
+    """
+    Follow the changing spectrum of a WAV file with the Gameduino's voices, yielding
+    for every tick the list of voices to rewrite.
+
+    :param wavfile: name of a PCM WAV file, as for :func:`wavspectrum`
+    :param tickrate: updates per second, for example 60 to update once per frame
+    :param voices: number of voices to use
+    :param volume: total volume of all the voices when the input is at full scale
+    :param size: FFT size
+    :param hold: how much louder a new frequency must be than one already playing to take its place
+    :param ftol: relative change of frequency below which a voice is not rewritten
+    :param atol: change of amplitude up to which a voice is not rewritten
+    :rtype: iterator giving, for each tick, a list of (voice, frequency, amplitude)
+
+    The file is read one tick at a time, so long recordings take no more memory than short ones.
+    Each tick, the strongest peaks of the spectrum of the last ``size`` samples are given voices.
+    A peak near the frequency of a voice already playing stays on that voice, and is preferred
+    by a factor of ``hold`` over new peaks, so voices change only when the sound does.
+    A voice that loses its peak is silenced.  To play the schedule::
+
+        for updates in voiceschedule("speech.wav"):
+            for (v, f, a) in updates:
+                gd.voice(v, 0, int(4 * f), a, a)
+            wait_for_next_frame()
+
+    :func:`dumpvoices` writes the schedule to a header file.
+    """
+
+    w = wave.open(wavfile, "rb")
+    try:
+        (channels, width, rate) = w.getparams()[:3]
+        hop = int(rate / tickrate)
+        window = numpy.hanning(size)
+        # a full-scale sine gives peak magnitude 1
+        scale = 2. / window.sum() / {1: 128., 2: 32768., 3: 8388608., 4: 2147483648.}[width]
+        track = 2           # bins a peak may move between ticks and keep its voice
+        freqs = numpy.arange(size / 2 + 1) * float(rate) / size
+        band = numpy.flatnonzero((40 < freqs) & (freqs < 8192))
+        band = band[(band > 0) & (band < size / 2)]
+
+        buf = numpy.zeros(size)
+        playing = {}        # voice -> bin it follows
+        written = [(0., 0)] * voices
+        while True:
+            raw = w.readframes(hop)
+            if not raw:
+                break
+            x = pcm(raw, width, channels)
+            buf = numpy.concatenate([buf, x])[-size:]
+            mag = numpy.abs(numpy.fft.rfft(buf * window)) * scale
+
+            # Local maxima; those near a playing voice get the bonus
+            m = mag[band]
+            peaks = band[(m > mag[band - 1]) & (m >= mag[band + 1]) & (m * volume >= .5)]
+            score = mag[peaks].copy()
+            for b in playing.values():
+                score[abs(peaks - b) <= track] *= hold
+            if len(peaks) > voices:
+                peaks = peaks[numpy.argpartition(-score, voices - 1)[:voices]]
+            peaks = sorted(peaks.tolist(), key = lambda b: -mag[b])
+
+            # Keep voices on their peaks, give new peaks free voices
+            following = {}
+            for b in peaks:
+                near = [(abs(b - pb), v) for (v, pb) in playing.items() if abs(b - pb) <= track and not v in following]
+                if near:
+                    following[min(near)[1]] = b
+            free = [v for v in range(voices) if not v in following and not v in playing]
+            free += [v for v in sorted(playing) if not v in following]
+            for b in peaks:
+                if not b in following.values():
+                    following[free.pop(0)] = b
+            playing = following
+
+            # Peak frequency by parabolic interpolation of the log magnitude
+            amps = {}
+            for (v, b) in playing.items():
+                (l, c, r) = numpy.log(mag[b - 1:b + 2] + 1e-12)
+                d = .5 * (l - r) / (l - 2 * c + r) if l - 2 * c + r < 0 else 0.
+                amps[v] = ((b + d) * float(rate) / size, volume * mag[b])
+            total = sum([a for (_, a) in amps.values()])
+            k = min(1., volume / total) if total else 1.
+            updates = []
+            for v in range(voices):
+                (f, a) = amps.get(v, (written[v][0], 0.))
+                a = int(k * a + .5)
+                (f0, a0) = written[v]
+                if (a == 0) != (a0 == 0) or (a and (abs(a - a0) > atol or abs(f - f0) > ftol * f0)):
+                    written[v] = (f, a)
+                    updates.append((v, f, a))
+            yield updates
+    finally:
+        w.close()
+
+PLAY_VOICES = """\
+static prog_uchar *%(name)s_tick(prog_uchar *p)
+{
+  byte n = pgm_read_byte_near(p++);
+  while (n--) {
+    byte a = pgm_read_byte_near(p + 3);
+    GD.voice(pgm_read_byte_near(p), 0, pgm_read_word_near(p + 1), a, a);
+    p += 4;
+  }
+  return p;
+}
+"""
+
+def dumpvoices(hh, name, schedule):
+    """
+    Write a voice schedule, as from :func:`voiceschedule`, to a header file.
+
+    :param hh: destination header file
+    :param name: name of the schedule, used for the generated C identifiers
+    :param schedule: iterable giving, for each tick, a list of (voice, frequency, amplitude)
+    :rtype: the stream as an :class:`array.array` of type 'B'
+
+    For every tick the stream holds the number of updates (1 byte), then for each: the voice (1 byte),
+    the frequency in quarter-Hz (2 bytes, little-endian) and the amplitude (1 byte).
+    The header file gets the stream ``name_voices``, ``NAME_TICKS`` and a function ``name_tick()``
+    that plays one tick and returns where the next begins.
+    """
 
-__all__ = [ "encode", "dump", "palettize", "getpal", "ImageRAM", "spectrum", ]
+    stream = array('B')
+    ticks = 0
+    for updates in schedule:
+        stream.append(len(updates))
+        for (v, f, a) in updates:
+            q = min(int(4 * f), 0xffff)
+            stream.extend(array('B', [v, q & 0xff, q >> 8, a]))
+        ticks += 1
+    print >>hh, "// %s: %d ticks, %d bytes" % (name, ticks, len(stream))
+    dump(hh, "%s_voices" % name, stream)
+    print >>hh, "#define %s_TICKS %d" % (name.upper(), ticks)
+    hh.write(PLAY_VOICES % {'name': name})
+    return stream
+
+__all__ = [ "encode", "encode_lossy", "encode_many", "encode_frames", "dump", "compress", "decompress", "dumpbin", "dumpmmap", "preview", "preview_sprites", "palettize", "getpal", "sharepalettes", "ImageRAM", "BankedImageRAM", "Cache", "spectrum", "wavspectrum", "spectra", "voiceschedule", "dumpvoices", ]
@@ -0,0 +1,118 @@
+import unittest
+import array
+import os
+
+import numpy
+
+import genrams
+
+# The per-element INIT generators the numpy versions replaced, kept as the specification of their output
+
+def reference_geninit1(img, i):
+    r = []
+    for j in range(64):
+        bytes = img[256 * j:256 * (j + 1)][::-1]
+        bits = [(1 & (b >> i)) for b in bytes]
+        r.append(".INIT_%02X(256'b%s)" % (j, "".join([str(b) for b in bits])))
+    return ",\n".join(r)
+
+def reference_geninit4i(img, i):
+    r = []
+    for j in range(64):
+        bytes = img[64 * j:64 * (j + 1)]
+        bits = [genrams.deinterleave(b, i) for b in bytes][::-1]
+        r.append(".INIT_%02X(256'h%s)" % (j, "".join(["%X"%b for b in bits])))
+    return ",\n".join(r)
+
+def reference_geninit4(img, i):
+    r = []
+    for j in range(64):
+        bytes = img[64 * j:64 * (j + 1)]
+        bits = [(15 & (b >> (4 * i))) for b in bytes][::-1]
+        r.append(".INIT_%02X(256'h%s)" % (j, "".join(["%X"%b for b in bits])))
+    return ",\n".join(r)
+
+def reference_geninit8(img):
+    r = []
+    for j in range(64):
+        bytes = img[32 * j:32 * (j + 1)][::-1]
+        r.append(".INIT_%02X(256'h%s)" % (j, "".join(["%02X"%b for b in bytes])))
+    return ",".join(r)
+
+def reference_geninit128x1(img, i):
+    bits = [(1 & (b >> i)) for b in img][::-1]
+    return ".INIT(128'b%s)" % "".join([str(b) for b in bits])
+
+class TestGenInit(unittest.TestCase):
+
+    def setUp(self):
+        rs = numpy.random.RandomState(21)
+        self.mem = array.array('B', rs.randint(0, 256, 32768).astype(numpy.uint8).tostring())
+
+    def test_geninit1(self):
+        for i in range(8):
+            self.assertEqual(genrams.geninit1(self.mem[0x4000:], i), reference_geninit1(self.mem[0x4000:], i))
+
+    def test_geninit4(self):
+        for i in range(2):
+            self.assertEqual(genrams.geninit4(self.mem[:0x1000], i), reference_geninit4(self.mem[:0x1000], i))
+
+    def test_geninit4i(self):
+        for i in range(2):
+            self.assertEqual(genrams.geninit4i(self.mem[0x1000:0x2000], i), reference_geninit4i(self.mem[0x1000:0x2000], i))
+
+    def test_geninit8(self):
+        for start in range(0, 0x8000, 0x800):
+            self.assertEqual(genrams.geninit8(self.mem[start:start + 0x800]), reference_geninit8(self.mem[start:start + 0x800]))
+
+    def test_geninit128x1(self):
+        for i in range(8):
+            self.assertEqual(genrams.geninit128x1(self.mem[:128], i), reference_geninit128x1(self.mem[:128], i))
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+class TestBitstream(unittest.TestCase):
+
+    def setUp(self):
+        self.top = open(os.path.join(here, "top.bit"), "rb").read()
+        self.rams = genrams.brams(open(os.path.join(here, "..", "src", "gameduino", "generated.v")).read())
+
+    def test_crc(self):
+        bit = genrams.Bitstream(self.top)
+        self.assertEqual(bit.crc(), 0)
+        self.assertEqual(bit.tostring(), self.top)
+
+    def test_padding_after_desync(self):
+        fn = os.path.join(here, "..", "..", "..", "PlusToo_scsi", "tools", "cm93.bit")
+        if not os.path.exists(fn):
+            self.skipTest("no PlusToo_scsi bitstream")
+        data = open(fn, "rb").read()
+        bit = genrams.Bitstream(data)
+        self.assertEqual(bit.crc(), 0)
+        self.assertEqual(bit.tostring(), data)
+
+    def test_locate(self):
+        placements = genrams.locate(genrams.Bitstream(self.top), self.rams)
+        self.assertEqual(len(self.rams), 15)
+        self.assertEqual(sorted(placements), sorted([n for (n, _, _) in self.rams]))
+        self.assertEqual(len(set(placements.values())), 15)
+
+    def test_patch_roundtrip(self):
+        placements = genrams.locate(genrams.Bitstream(self.top), self.rams)
+        rs = numpy.random.RandomState(24)
+        new = [(n, w, rs.randint(0, 2, len(bits)).astype(bits.dtype)) for (n, w, bits) in self.rams]
+        (patched, changed) = genrams.patchbit(self.top, new, placements)
+        self.assertEqual(len(changed), 15)
+        bit = genrams.Bitstream(patched)
+        self.assertEqual(bit.crc(), 0)
+        for (n, w, bits) in new:
+            self.assertTrue(numpy.array_equal(bit.read(placements[n], w), bits), n)
+        (back, changed) = genrams.patchbit(patched, self.rams, placements)
+        self.assertEqual(back, self.top)
+
+    def test_same_contents(self):
+        placements = genrams.locate(genrams.Bitstream(self.top), self.rams)
+        self.assertEqual(genrams.patchbit(self.top, self.rams, placements), (self.top, []))
+
+if __name__ == '__main__':
+    unittest.main()
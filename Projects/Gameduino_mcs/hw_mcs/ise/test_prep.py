@@ -0,0 +1,296 @@
+import unittest
+import random
+import os
+import shutil
+import tempfile
+import StringIO
+import wave
+import zlib
+import math
+from array import array
+
+import numpy
+import Image
+
+import prep
+
+def reference_encodech(imdata):
+    # The per-pixel glyph packer encodechars() replaced
+    (rgbs, palette) = prep.rgbpal(imdata)
+    indices = [palette.index(c) for c in rgbs]
+    indices_b = ""
+    for i in range(0, len(indices), 4):
+        c =   ((indices[i] << 6) +
+               (indices[i + 1] << 4) +
+               (indices[i + 2] << 2) +
+               (indices[i + 3]))
+        indices_b += (chr(c))
+    palette = (palette + ([(0,0,0,255)] * 4))[:4]   # unused palette entries: opaque black
+    ph = array('H', [prep.rgba1555(*p) for p in palette])
+    return (indices_b, ph)
+
+def reference_encode(im):
+    # The cell-at-a-time encode(), kept as the specification of its output
+    if im.mode != "RGBA":
+        im = im.convert("RGBA")
+    charset = {}
+    picture = []
+    for y in range(0, im.size[1], 8):
+        for x in range(0, im.size[0], 8):
+            glyph = prep.getch(im, x, y).tostring()
+            if not glyph in charset:
+                if len(charset) == 256:
+                    raise OverflowError
+                charset[glyph] = len(charset)
+            picture.append(charset[glyph])
+    picd = array('B', picture)
+    cd = array('B', [0] * 16 * len(charset))
+    pd = array('H', [0] * 4 * len(charset))
+    for d,i in charset.items():
+        (char, pal) = reference_encodech(d)
+        cd[16 * i:16 * (i+1)] = array('B', char)
+        pd[4 * i:4 * (i+1)] = pal
+    return (picd, cd, pd)
+
+def tiled(seed, ncolors, size = (128, 128), ntiles = 40):
+    # An image repeating ntiles random cells, each drawn from ncolors random RGBA colors
+    r = random.Random(seed)
+    tiles = []
+    for t in range(ntiles):
+        cols = [(r.randrange(256), r.randrange(256), r.randrange(256), r.choice([0, 255])) for i in range(ncolors)]
+        tiles.append([r.choice(cols) for i in range(64)])
+    (w, h) = size
+    im = Image.new("RGBA", size)
+    im.putdata([tiles[((y / 8) * 7 + (x / 8) * 3) % ntiles][(y % 8) * 8 + x % 8] for y in range(h) for x in range(w)])
+    return im
+
+class TestEncode(unittest.TestCase):
+
+    def assertSameEncoding(self, im):
+        self.assertEqual(prep.encode(im), reference_encode(im))
+
+    def test_few_colors(self):
+        for n in range(1, 5):
+            self.assertSameEncoding(tiled(n, n))
+
+    def test_many_colors(self):
+        # cells of more than 4 colors are quantized first
+        for n in (5, 8, 64):
+            self.assertSameEncoding(tiled(n, n))
+
+    def test_mixed(self):
+        r = random.Random(9)
+        im = tiled(9, 4)
+        for i in range(200):
+            im.putpixel((r.randrange(128), r.randrange(128)), (r.randrange(256), r.randrange(256), r.randrange(256), 255))
+        self.assertSameEncoding(im)
+
+    def test_rgb(self):
+        self.assertSameEncoding(tiled(10, 6).convert("RGB"))
+
+    def test_encodech(self):
+        r = random.Random(11)
+        for i in range(256):
+            cols = [chr(r.randrange(256)) * 3 + chr(r.choice([0, 255])) for c in range(r.randrange(1, 5))]
+            imdata = "".join([r.choice(cols) for p in range(64)])
+            (cd, pd) = prep.encodech(imdata)
+            self.assertEqual((cd, pd), reference_encodech(imdata))
+
+    def test_encodechars(self):
+        r = random.Random(12)
+        glyphs = []
+        for i in range(256):
+            cols = [r.randrange(1 << 32) for c in range(r.randrange(1, 5))]
+            glyphs.append([r.choice(cols) for p in range(64)])
+        g = numpy.array(glyphs, numpy.uint32)
+        (cd, pd) = prep.encodechars(g)
+        for i in range(256):
+            (c, p) = reference_encodech(g[i].tostring())
+            self.assertEqual(cd[16 * i:16 * (i + 1)].tostring(), c)
+            self.assertEqual(pd[4 * i:4 * (i + 1)], p)
+
+    def test_overflow(self):
+        self.assertRaises(OverflowError, prep.encode, tiled(13, 4, (256, 256), 300))
+
+    def test_preview(self):
+        # full and zero intensities survive the 5-bit palette exactly
+        im = Image.eval(tiled(16, 4, (96, 40)).convert("RGB"), lambda v: 255 * (v > 127))
+        (picd, cd, pd) = prep.encode(im)
+        out = prep.preview(picd, cd, pd, 12)
+        self.assertEqual(out.size, (96, 40))
+        self.assertEqual(out.tostring(), im.tostring())
+        self.assertRaises(AssertionError, prep.preview, picd, cd, pd, 7)
+
+class TestDump(unittest.TestCase):
+
+    def test_unpack_once(self):
+        hh = StringIO.StringIO()
+        prep.dump(hh, "plain", array('B', range(16)))
+        self.assertFalse("gd_unpack" in hh.getvalue())
+        prep.dump(hh, "rle", array('B', [0] * 300), codec = "rle")
+        prep.dump(hh, "lz", array('B', range(50) * 8), codec = "lz")
+        self.assertEqual(hh.getvalue().count("static void gd_unpack("), 1)
+
+class TestCompress(unittest.TestCase):
+
+    def cases(self):
+        r = random.Random(20)
+        noise = [r.randrange(256) for i in range(256)]
+        return [[], [7], [0] * 129, [0] * 130, [5] * 131, [1, 2] + [9] * 300 + [3],
+                noise[:129], noise + noise, noise + [1] + noise[:200],
+                range(50) * 8, [r.choice([0, 0, 0, 1, 2]) for i in range(3000)]]
+
+    def test_roundtrip(self):
+        for data in self.cases():
+            data = array('B', data)
+            for codec in ("raw", "rle", "lz", "auto"):
+                (used, packed) = prep.compress(data, codec)
+                self.assertEqual(prep.decompress(used, packed), data, (codec, len(data)))
+                self.assertEqual(prep.decompress(prep.CODECS.index(used), packed), data)
+
+    def test_longest_reach(self):
+        # a repeat exactly 256 bytes back is found, in copies of at most 130 bytes
+        r = random.Random(21)
+        noise = [r.randrange(256) for i in range(256)]
+        (_, packed) = prep.compress(array('B', noise + noise), "lz")
+        tokens = []
+        i = 0
+        while i < len(packed):
+            t = packed[i]
+            tokens.append((t, packed[i + 1]))
+            i += t + 2 if t < 128 else 2
+        copies = [(t - 125, d + 1) for (t, d) in tokens if t >= 128]
+        self.assertEqual(copies, [(130, 256), (126, 256)])
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_corrupt_entry(self):
+        im = tiled(15, 4)
+        cache = prep.Cache(self.path)
+        want = cache.encode(im)
+        (key,) = os.listdir(self.path)
+        good = open(os.path.join(self.path, key), "rb").read()
+        for junk in ("", "not zlib", good[:-9], zlib.compress("not a pickle"), zlib.compress(zlib.decompress(good)[:-9])):
+            open(os.path.join(self.path, key), "wb").write(junk)
+            self.assertEqual(cache.encode(im), want)
+            self.assertEqual(cache.get(key), want)
+
+    def test_keyed_on_source(self):
+        key = prep.digest('encode', (tiled(15, 4),))
+        saved = prep.SOURCE
+        try:
+            prep.SOURCE = "edited"
+            self.assertNotEqual(prep.digest('encode', (tiled(15, 4),)), key)
+        finally:
+            prep.SOURCE = saved
+
+class TestBankedImageRAM(unittest.TestCase):
+
+    def sprites(self, seed):
+        return prep.palettize(tiled(seed, 4, (64, 16)), 16)
+
+    def test_unknown_set(self):
+        br = prep.BankedImageRAM(StringIO.StringIO())
+        br.addsprites("ship", (16, 16), self.sprites(16), prep.PALETTE16A)
+        br.scene("title", ["ship", "shipp"])
+        self.assertRaises(KeyError, br.pack)
+
+    def test_scene_underscore(self):
+        # ("a_b", "c") and ("a", "b_c") would both be sprites_swap_a_b_c
+        br = prep.BankedImageRAM(StringIO.StringIO())
+        self.assertRaises(ValueError, br.scene, "a_b", [])
+
+    def test_scene_named_cold(self):
+        hh = StringIO.StringIO()
+        br = prep.BankedImageRAM(hh)
+        br.addsprites("ship", (16, 16), self.sprites(17), prep.PALETTE16A)
+        br.addsprites("rock", (16, 16), self.sprites(18), prep.PALETTE16B)
+        br.scene("cold", ["ship"])
+        br.scene("title", ["rock"])
+        plan = br.pack([(None, "title"), ("cold", "title")])
+        self.assertEqual(sorted(plan.keys()), [(None, "title"), ("cold", "title")])
+        self.assertTrue("sprites_load_title[]" in hh.getvalue())
+        self.assertTrue("sprites_swap_cold_title[]" in hh.getvalue())
+
+def writewav(path, rate, tones, seconds = 1.):
+    # A 16-bit mono WAV file of the sum of sines, tones listing (frequency, amplitude) with amplitudes in 0-1
+    t = numpy.arange(int(rate * seconds)) / float(rate)
+    x = sum([a * numpy.sin(2 * numpy.pi * f * t) for (f, a) in tones])
+    w = wave.open(path, "wb")
+    w.setparams((1, 2, rate, len(t), "NONE", "not compressed"))
+    w.writeframes((32767 * x).astype("<i2").tostring())
+    w.close()
+
+def reference_spectrum(specfile, cutoff = 64, volume = 255):
+    # The original list-sorting spectrum()
+    snd = [[float(t) for t in l.split()] for l in open(specfile) if not "Freq" in l]
+    snd = [(f,db) for (f,db) in snd if 40 < f < 8192]
+    snd = sorted(snd, reverse=True, key=lambda t:t[1])
+    top = snd[:cutoff]
+    amps = [(f,math.pow(2, .1 * db)) for (f, db) in top]
+    samps = sum([a for (f,a) in amps])
+    return [(f, int(volume * a / samps)) for (f, a) in amps]
+
+def writespectrum(path, rate, size, tones, floor = -60.):
+    # An Audacity spectrum export: tones, (frequency, dB) pairs with window skirts, on a flat floor
+    freq = numpy.arange(1, size / 2) * float(rate) / size
+    db = numpy.zeros(len(freq)) + floor
+    for (f, level) in tones:
+        k = int(round(f * size / rate)) - 1
+        for (d, drop) in ((0, 0.), (-1, 6.), (1, 6.), (-2, 20.), (2, 20.)):
+            db[k + d] = max(db[k + d], level - drop)
+    f = open(path, "w")
+    f.write("Frequency (Hz)\tLevel (dB)\n")
+    f.writelines(["%f\t%f\n" % (a, b) for (a, b) in zip(freq, db)])
+    f.close()
+
+class TestSound(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_spectrum(self):
+        fn = os.path.join(self.path, "export.txt")
+        writespectrum(fn, 44100, 2048, [(440, -12.), (1320, -20.)])
+        for cutoff in (1, 3, 8, 64):
+            self.assertEqual(prep.spectrum(fn, cutoff), reference_spectrum(fn, cutoff))
+
+    def test_peaks_on_flat_floor(self):
+        fn = os.path.join(self.path, "export.txt")
+        writespectrum(fn, 44100, 2048, [(440, -12.), (1320, -20.)])
+        (freq, db) = numpy.loadtxt(fn, skiprows = 1).T
+        found = prep.loudest(freq, db, 64, 255, peaks = True)
+        self.assertEqual(len(found), 2)
+        for ((f, a), want) in zip(found, (440, 1320)):
+            self.assertTrue(abs(f - want) < 44100. / 2048, (f, want))
+
+    def test_wavspectrum_peaks(self):
+        fn = os.path.join(self.path, "chord.wav")
+        writewav(fn, 22050, [(440, .4), (660, .2), (1320, .1)])
+        found = prep.wavspectrum(fn, cutoff = 3)
+        self.assertEqual(len(found), 3)
+        for ((f, a), want) in zip(found, (440, 660, 1320)):
+            self.assertTrue(abs(f - want) < 22050. / 8192, (f, want))
+        self.assertTrue(found[0][1] > found[1][1] > found[2][1])
+
+    def test_voiceschedule_long_ticks(self):
+        # at 44.1 kHz and 20 ticks per second, each tick reads more than size samples
+        fn = os.path.join(self.path, "tone.wav")
+        writewav(fn, 44100, [(1000, .5)], .5)
+        ticks = list(prep.voiceschedule(fn, tickrate = 20, voices = 4))
+        self.assertEqual(len(ticks), 10)
+        ((v, f, a),) = ticks[0]
+        self.assertTrue(abs(f - 1000) < 5, f)
+        self.assertEqual(ticks[1:], [[]] * 9)
+
+if __name__ == '__main__':
+    unittest.main()